@@ -30,4 +30,45 @@ additional_folders = <value>
 * This suggests additional folders to read messages via IMAP
 
 drop_attachment = <bool>
-* This determines if an email attachment will be indexed
\ No newline at end of file
+* This determines if an email attachment will be indexed
+
+fetch_batch_size = <integer>
+* The number of mails fetched in a single IMAP round trip, split so that each fetches at most 16 MB of whole mails.
+* Checkpoints are saved after every batch, and every this many POP3 mails.
+* Defaults to 25.
+
+checkpoint_retention_days = <integer>
+* Checkpoints of mails indexed more than this number of days ago are removed at the end of each run.
+* Defaults to 0, which keeps checkpoints forever.
+
+checkpoint_prune_missing = <bool>
+* This determines if checkpoints of mails that are no longer on the server should be removed.
+* The full list of mails on the server is read on every run when this is enabled.
+
+attachment_hashes = <value>
+* Comma-separated list of digests computed for every attachment (md5, sha1, sha224, sha256, sha384, sha512),
+* or none. IMAP mails are fetched without their attachments when this is none and drop_attachment is enabled.
+* Defaults to md5,sha256.
+
+parse_processes = <integer>
+* Number of processes used to parse mails, so that attachments can be parsed on more than one CPU core.
+* Defaults to 0, which parses mails within the modular input process.
+
+imap_idle = <bool>
+* This determines if a connection is kept in IDLE for every IMAP folder, to index new mails as soon as they are delivered.
+* Defaults to false, which polls the folders at every interval.
+
+connect_timeout = <integer>
+* Seconds to wait for the connection to the mail server, including the TLS handshake. Defaults to 30.
+
+read_timeout = <integer>
+* Seconds to wait for each response of the mail server. Defaults to 300.
+
+spool_threshold_mb = <integer>
+* Mails larger than this many MB are fetched into a temporary file instead of memory, and parsed from it.
+* Defaults to 10. 0 holds every mail in memory.
+
+max_event_size = <integer>
+* Events are cut to this many bytes and end with a #TRUNCATED line, as TRUNCATE in props.conf would cut them.
+* With drop_attachment and attachment_hashes = none, IMAP only downloads the start of larger mails.
+* Defaults to 200000. 0 keeps whole events.
@@ -0,0 +1,66 @@
+"""
+This measures the peak memory and time of parsing a large mail from the bytes fetched over IMAP (a literal) and
+POP3 (a list of lines), against parsing the same mail decoded to a string first, as the input used to do. The mail
+has an 8bit utf-8 text part and a base64 attachment, and the output is checked for the text part.
+
+    python benchmarks/bench_bytes_parse.py [size in MB]
+"""
+
+from __future__ import print_function
+
+import base64
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+from file_parser import email_mime
+
+TEXT = 'Grüße aus Köln, line of text for the body\r\n'
+
+
+def build_mail(size):
+    attachment = base64.encodebytes(os.urandom(size * 3 // 4)).replace(b'\n', b'\r\n')
+    return (b'From: a@b.com\r\nTo: c@d.com\r\nSubject: =?utf-8?q?Gr=C3=BC=C3=9Fe?=\r\n'
+            b'Date: Fri, 17 Jul 2020 02:44:25 -0700\r\nMessage-ID: <big@example.com>\r\nMIME-Version: 1.0\r\n'
+            b'Content-Type: multipart/mixed; boundary="BB"\r\n\r\n--BB\r\n'
+            b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: 8bit\r\n\r\n' +
+            (TEXT * 40).encode('utf-8') +
+            b'\r\n--BB\r\nContent-Type: application/octet-stream; name="x.bin"\r\n'
+            b'Content-Transfer-Encoding: base64\r\nContent-Disposition: attachment; filename="x.bin"\r\n\r\n' +
+            attachment + b'\r\n--BB--\r\n')
+
+
+def measure(parse):
+    parse()
+    tracemalloc.start()
+    started = time.time()
+    result = parse()
+    elapsed = time.time() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, elapsed, TEXT.strip() in result[2]
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    raw_email = build_mail(size * 1024 * 1024)
+    lines = raw_email.split(b'\r\n')
+    inputs = (
+        ('IMAP literal, decoded to a string', lambda: raw_email.decode('ascii', 'replace')),
+        ('IMAP literal, as bytes', lambda: raw_email),
+        ('POP3 lines, joined to a string', lambda: '\n'.join(line.decode('utf-8', 'ignore') for line in lines)),
+        ('POP3 lines, as bytes', lambda: lines),
+    )
+    print("%.1f MB mail" % (len(raw_email) / 1048576.0))
+    for maintain_rfc in (False, True):
+        for label, get_input in inputs:
+            peak, elapsed, text_kept = measure(
+                lambda: email_mime.parse_email(get_input(), True, maintain_rfc, False))
+            print("maintain_rfc=%s, %s: peak %.1f MB, %.0f ms, 8bit text kept: %s" % (
+                maintain_rfc, label, peak / 1048576.0, elapsed * 1000, text_kept))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+This measures the per-mail latency of parse_email over a corpus of attachment-heavy mails, next to the cost of the
+header round trip it no longer does: serialising the parsed message with as_string() and parsing that again with
+Parser().parsestr(..., True) to list the headers.
+
+    python benchmarks/bench_header_parse.py [mails]
+"""
+
+from __future__ import print_function
+
+import base64
+import os
+import random
+import statistics
+import sys
+import time
+from email.parser import Parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+from file_parser import email_mime
+
+
+def build_mail(i, size):
+    attachment = base64.encodebytes(os.urandom(size * 3 // 4)).replace(b'\n', b'\r\n')
+    received = b''.join(b'Received: from relay%d.example.com by mx.example.com; Fri, 17 Jul 2020 02:44:25 -0700\r\n'
+                        % j for j in range(8))
+    return (received + b'From: =?utf-8?q?J=C3=BCrgen?= <a@b.com>\r\nTo: c@d.com\r\n'
+            b'Subject: =?utf-8?q?report_=C3=BC_%d?=\r\nDate: Fri, 17 Jul 2020 02:44:25 -0700\r\n'
+            b'Message-ID: <report%d@example.com>\r\nMIME-Version: 1.0\r\n'
+            b'Content-Type: multipart/mixed; boundary="BB"\r\n\r\n--BB\r\n'
+            b'Content-Type: text/plain; charset=utf-8\r\n\r\nsee attached\r\n'
+            b'--BB\r\nContent-Type: application/pdf; name="r.pdf"\r\n'
+            b'Content-Transfer-Encoding: base64\r\nContent-Disposition: attachment; filename="r.pdf"\r\n\r\n' % (i, i) +
+            attachment + b'\r\n--BB--\r\n')
+
+
+def summary(times):
+    return "median %.1f ms, mean %.1f ms, max %.1f ms" % (statistics.median(times), statistics.mean(times), max(times))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    random.seed(1)
+    corpus = [build_mail(i, random.choice([256, 1024, 5120, 20480]) * 1024) for i in range(count)]
+    print("%d mails, %.1f MB" % (count, sum(len(raw_email) for raw_email in corpus) / 1048576.0))
+    for maintain_rfc in (False, True):
+        times = []
+        for raw_email in corpus:
+            started = time.time()
+            email_mime.parse_email(raw_email, True, maintain_rfc, False)
+            times.append((time.time() - started) * 1000)
+        print("parse_email, maintain_rfc=%s: %s" % (maintain_rfc, summary(times)))
+    times = []
+    for raw_email in corpus:
+        message = email_mime.message_from_raw(raw_email)
+        started = time.time()
+        Parser().parsestr(message.as_string(), True).items()
+        times.append((time.time() - started) * 1000)
+    print("header round trip no longer done for maintain_rfc=False: %s" % summary(times))
+
+
+if __name__ == '__main__':
+    main()
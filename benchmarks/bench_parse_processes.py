@@ -0,0 +1,82 @@
+"""
+This measures how parsing an attachment-heavy corpus scales with parse_processes. Every mail carries a zip with
+text files and a docx, which file_parser extracts in pure Python. Mails are parsed in order through the same
+parse_mail function and process pool the input uses, and the output is checked against parsing in-process.
+
+    python benchmarks/bench_parse_processes.py [mails] [max processes]
+"""
+
+from __future__ import print_function
+
+import base64
+import io
+import multiprocessing
+import os
+import sys
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+from mail_pipeline import parse_mail, create_parse_pool
+
+CONTENT_TYPES = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                 '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"/>')
+DOCX_DOCUMENT = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                 '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>%s'
+                 '</w:body></w:document>')
+
+
+def build_zip(files):
+    buf = io.BytesIO()
+    archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+    for name, content in files:
+        archive.writestr(name, content)
+    archive.close()
+    return buf.getvalue()
+
+
+def build_mail(i):
+    text_zip = build_zip([('file%d.txt' % j, ''.join('line %d of file %d in mail %d\n' % (k, j, i)
+                                                      for k in range(2000))) for j in range(10)])
+    docx = build_zip([('[Content_Types].xml', CONTENT_TYPES), ('word/document.xml', DOCX_DOCUMENT % ''.join(
+        '<w:p><w:r><w:t>Paragraph %d of mail %d</w:t></w:r></w:p>' % (k, i) for k in range(3000)))])
+    attachments = b''.join(
+        b'--BB\r\nContent-Type: application/octet-stream; name="%s"\r\nContent-Transfer-Encoding: base64\r\n'
+        b'Content-Disposition: attachment; filename="%s"\r\n\r\n' % (name, name) +
+        base64.encodebytes(data).replace(b'\n', b'\r\n') for name, data in ((b'logs.zip', text_zip),
+                                                                             (b'report.docx', docx)))
+    return (b'From: a@b.com\r\nTo: c@d.com\r\nSubject: report %d\r\nDate: Fri, 17 Jul 2020 02:44:25 -0700\r\n'
+            b'Message-ID: <report%d@example.com>\r\nContent-Type: multipart/mixed; boundary="BB"\r\n\r\n'
+            b'--BB\r\nContent-Type: text/plain\r\n\r\nsee attached\r\n' % (i, i) + attachments + b'--BB--\r\n')
+
+
+def parse(raw_email):
+    return parse_mail(raw_email, True, False, False, ['md5', 'sha256'], False)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    max_processes = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    corpus = [build_mail(i) for i in range(count)]
+    print("%d mails, %.1f MB, %d CPUs" % (count, sum(len(raw) for raw in corpus) / 1048576.0,
+                                          multiprocessing.cpu_count()))
+    started = time.time()
+    expected = [parse(raw_email) for raw_email in corpus]
+    baseline = time.time() - started
+    print("in-process: %.2fs" % baseline)
+    processes = 1
+    while processes <= max_processes:
+        pool = create_parse_pool(processes)
+        pool.map(parse, corpus[:processes])
+        started = time.time()
+        results = list(pool.imap(parse, corpus))
+        elapsed = time.time() - started
+        pool.close()
+        pool.join()
+        print("parse_processes=%d: %.2fs, %.2fx in-process, same output in order: %s" % (
+            processes, elapsed, baseline / elapsed, results == expected))
+        processes *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,16 @@
 
 from __future__ import unicode_literals
 
+import functools
 import imaplib
 import poplib
 # import libraries required
 import re
 import os
 import sys
+import tempfile
+import threading
+import time
 import traceback
 from ssl import SSLError
 
@@ -15,6 +19,10 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
 from mail_constants import *
 from mail_exceptions import *
 from mail_utils import *
+from mail_checkpoint import *
+from mail_pipeline import *
+from mail_scheduler import *
+from mail_connection import *
 from file_parser import *
 from splunklib.modularinput import *
 from six import ensure_str
@@ -37,6 +45,10 @@ class Mail(Script):
         self.log = EventWriter.log
         self.write_event = EventWriter.write_event
         self.checkpoint_dir = ""
+        self.checkpoints = None
+        self.parse_pool = None
+        self.connections = None
+        self.idle_threads = {}
 
     # noinspection PyShadowingNames
     def get_scheme(self):
@@ -44,6 +56,7 @@ class Mail(Script):
         scheme = Scheme("Mail Server")
         scheme.description = "Streams events from from a mail server."
         scheme.use_external_validation = True
+        scheme.use_single_instance = SINGLE_INSTANCE_MODE
         name = Argument(
             name="name",
             title="E-mail",
@@ -140,6 +153,105 @@ class Mail(Script):
             required_on_create=False
         )
         scheme.add_argument(drop_attachment)
+        fetch_batch_size = Argument(
+            name="fetch_batch_size",
+            title="IMAP fetch batch size",
+            description="Number of mails fetched per IMAP round trip",
+            validation="is_pos_int('fetch_batch_size')",
+            data_type=Argument.data_type_number,
+            required_on_edit=False,
+            required_on_create=False
+        )
+        scheme.add_argument(fetch_batch_size)
+        checkpoint_retention_days = Argument(
+            name="checkpoint_retention_days",
+            title="Checkpoint retention (days)",
+            description="Checkpoints older than this are removed. 0 keeps them forever",
+            validation="is_nonneg_int('checkpoint_retention_days')",
+            data_type=Argument.data_type_number,
+            required_on_edit=False,
+            required_on_create=False
+        )
+        scheme.add_argument(checkpoint_retention_days)
+        checkpoint_prune_missing = Argument(
+            name="checkpoint_prune_missing",
+            title="Remove checkpoints of mails no longer on the server",
+            validation="is_bool('checkpoint_prune_missing')",
+            data_type=Argument.data_type_boolean,
+            required_on_edit=False,
+            required_on_create=False
+        )
+        scheme.add_argument(checkpoint_prune_missing)
+        attachment_hashes = Argument(
+            name="attachment_hashes",
+            title="Attachment hashes",
+            description="comma separated list of md5, sha1, sha224, sha256, sha384, sha512, or none",
+            validation="match('attachment_hashes','%s')" % REGEX_ATTACHMENT_HASHES,
+            data_type=Argument.data_type_string,
+            required_on_edit=False,
+            required_on_create=False
+        )
+        scheme.add_argument(attachment_hashes)
+        parse_processes = Argument(
+            name="parse_processes",
+            title="Parse processes",
+            description="Number of processes parsing mails. 0 parses them within the input process",
+            validation="is_nonneg_int('parse_processes')",
+            data_type=Argument.data_type_number,
+            required_on_edit=False,
+            required_on_create=False
+        )
+        scheme.add_argument(parse_processes)
+        imap_idle = Argument(
+            name="imap_idle",
+            title="IMAP IDLE",
+            description="Keep a connection per folder in IDLE and index new mails as soon as they are delivered",
+            validation="is_bool('imap_idle')",
+            data_type=Argument.data_type_boolean,
+            required_on_edit=False,
+            required_on_create=False
+        )
+        scheme.add_argument(imap_idle)
+        connect_timeout = Argument(
+            name="connect_timeout",
+            title="Connect timeout",
+            description="Seconds to wait for the connection to the mail server",
+            validation="is_pos_int('connect_timeout')",
+            data_type=Argument.data_type_number,
+            required_on_edit=False,
+            required_on_create=False
+        )
+        scheme.add_argument(connect_timeout)
+        read_timeout = Argument(
+            name="read_timeout",
+            title="Read timeout",
+            description="Seconds to wait for each response of the mail server",
+            validation="is_pos_int('read_timeout')",
+            data_type=Argument.data_type_number,
+            required_on_edit=False,
+            required_on_create=False
+        )
+        scheme.add_argument(read_timeout)
+        spool_threshold_mb = Argument(
+            name="spool_threshold_mb",
+            title="Spool threshold (MB)",
+            description="Mails larger than this are fetched into a temporary file instead of memory. 0 disables it",
+            validation="is_nonneg_int('spool_threshold_mb')",
+            data_type=Argument.data_type_number,
+            required_on_edit=False,
+            required_on_create=False
+        )
+        scheme.add_argument(spool_threshold_mb)
+        max_event_size = Argument(
+            name="max_event_size",
+            title="Maximum event size",
+            description="Events are cut to this many bytes, as TRUNCATE in props.conf does. 0 keeps whole events",
+            validation="is_nonneg_int('max_event_size')",
+            data_type=Argument.data_type_number,
+            required_on_edit=False,
+            required_on_create=False
+        )
+        scheme.add_argument(max_event_size)
         return scheme
 
     # noinspection PyShadowingNames
@@ -246,90 +358,621 @@ class Mail(Script):
                 self.mask_input_password()
                 return cred
 
-    def stream_imap_emails(self):
+    def imap_header_dedup(self, mailclient, email_ids, structures=None, sizes=None):
         """
-        :return: This returns a list of the messages retrieved via IMAP
+        This fetches only the Message-ID and Date headers of the given mails and checks them against
+        the checkpoints, so that bodies are only downloaded for mails that have not been indexed.
+        :param mailclient: IMAP connection with the folder selected
+        :type mailclient: imaplib.IMAP4
+        :param email_ids: UIDs of the candidate mails
+        :type email_ids: list
+        :param structures: When given, the BODYSTRUCTURE of the mails is fetched along with their headers, and
+         the parts of the mails that can be fetched without their attachments are added to it
+        :type structures: dict
+        :param sizes: When given, the RFC822.SIZE of the mails is fetched along with their headers and added to it
+        :type sizes: dict
+        :return: Returns a tuple with the UIDs still to be fetched and the UIDs already indexed
+        :rtype: tuple
+        """
+        result, header_data = mailclient.uid('fetch', build_uid_set(email_ids),
+                                             '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE)]%s%s)' % (
+                                                 ' BODYSTRUCTURE' if structures is not None else '',
+                                                 ' RFC822.SIZE' if sizes is not None else ''))
+        if result != 'OK':
+            return email_ids, []
+        indexed_ids = []
+        for uid, message_data in parse_fetch_response(header_data):
+            if sizes is not None and message_data.get('RFC822.SIZE'):
+                sizes[uid] = int(message_data['RFC822.SIZE'])
+            if structures is not None:
+                structure = parse_imap_bodystructure(message_data.get('BODYSTRUCTURE'))
+                if structure is not None:
+                    structures[uid] = structure
+            header = [v for k, v in message_data.items() if k.startswith('BODY[HEADER')]
+            if not header or not header[0]:
+                continue
+            message_time, message_mid = email_mime.parse_email_header(header[0])
+            if message_mid and self.checkpoints.locate_checkpoint(message_mid):
+                indexed_ids.append(uid)
+        return [uid for uid in email_ids if uid not in indexed_ids], indexed_ids
+
+    def imap_partial_fetch(self):
+        """
+        :return: Returns whether mails are fetched without their attachments. This is when attachments are dropped
+         and no attachment hashes are computed, and only in the output mode that drop_attachment applies to.
+        :rtype: bool
+        """
+        return self.drop_attachment and not self.attachment_hashes and not self.maintain_rfc and \
+            not self.attach_message_primary
+
+    def imap_prefix_size(self):
+        """
+        :return: Returns how many bytes of a mail, or of one of its text parts, are fetched when mails are fetched
+         without their attachments and events are cut to max_event_size, or 0 if mails are fetched whole
+        :rtype: int
+        """
+        if not self.max_event_size or not self.imap_partial_fetch():
+            return 0
+        return self.max_event_size * EVENT_FETCH_RATIO
+
+    def imap_fetch_mails(self, mailclient, email_ids, structures, sizes):
+        """
+        This fetches the given mails. Mails whose parts are known are rebuilt from their headers and text parts,
+        with one FETCH for every set of sections, while the other mails, and those that could not be rebuilt,
+        are fetched whole, by FETCHes of at most MAX_FETCH_BYTES. Mails larger than spool_threshold_mb are fetched
+        in chunks into a temporary file instead of being held in memory.
+        When imap_prefix_size is set, only the start of larger mails and text parts is fetched.
+        :param mailclient: IMAP connection with the folder selected
+        :type mailclient: imaplib.IMAP4
+        :param email_ids: UIDs of the mails
+        :type email_ids: list
+        :param structures: Parts of the mails, as returned by parse_imap_bodystructure
+        :type structures: dict
+        :param sizes: RFC822.SIZE of the mails. Sizes that are missing are fetched before the mails.
+        :type sizes: dict
+        :return: Returns the (uid, raw mail, delivery time, partial, size, truncated) of every mail in UID order,
+         or None if a FETCH failed. The size is the RFC822.SIZE of the mail when it is known, and truncated tells
+         whether only the start of the mail or of its text parts was fetched.
         :rtype: list
         """
-        # Define local variables
+        mails = {}
+        partial_ids = {}
+        full_ids = []
+        prefix_size = self.imap_prefix_size()
+        for uid in email_ids:
+            if uid in structures:
+                partial_ids.setdefault(' '.join(get_imap_partial_items(structures[uid], prefix_size)),
+                                       []).append(uid)
+            else:
+                full_ids.append(uid)
+        for items, uids in sorted(partial_ids.items()):
+            result, email_data = mailclient.uid('fetch', build_uid_set(uids), '(UID INTERNALDATE %s)' % items)
+            if result != 'OK':
+                return None
+            for uid, message_data in parse_fetch_response(email_data):
+                if uid not in uids:
+                    continue
+                raw_email = build_imap_partial_mail(structures[uid], message_data)
+                if raw_email is None:
+                    """Fetched whole instead, within the same limits as the other mails"""
+                    full_ids.append(uid)
+                else:
+                    mails[uid] = (uid, raw_email, get_imap_delivery_time(message_data), True, sizes.get(uid),
+                                  '<0.' in items)
+            del email_data
+        spool_ids = []
+        prefix_ids = []
+        if full_ids:
+            unsized_ids = [uid for uid in full_ids if uid not in sizes]
+            if unsized_ids:
+                result, size_data = mailclient.uid('fetch', build_uid_set(unsized_ids), '(UID RFC822.SIZE)')
+                if result == 'OK':
+                    for uid, message_data in parse_fetch_response(size_data):
+                        if message_data.get('RFC822.SIZE'):
+                            sizes[uid] = int(message_data['RFC822.SIZE'])
+            if prefix_size:
+                prefix_ids = [uid for uid in full_ids if sizes.get(uid, 0) > prefix_size]
+            if self.spool_threshold_mb:
+                spool_ids = [uid for uid in full_ids if uid not in prefix_ids and
+                             sizes.get(uid, 0) > self.spool_threshold_mb * 1024 * 1024]
+            full_ids = [uid for uid in full_ids if uid not in prefix_ids and uid not in spool_ids]
+        """imaplib holds a whole FETCH response in memory, so whole mails are fetched within MAX_FETCH_BYTES"""
+        for fetch_ids in split_uids_by_size(full_ids, sizes, MAX_FETCH_BYTES):
+            result, email_data = mailclient.uid('fetch', build_uid_set(fetch_ids), '(UID INTERNALDATE RFC822)')
+            if result != 'OK':
+                return None
+            for uid, message_data in parse_fetch_response(email_data):
+                if uid not in fetch_ids or not message_data.get('RFC822'):
+                    continue
+                mails[uid] = (uid, message_data['RFC822'], get_imap_delivery_time(message_data), False,
+                              sizes.get(uid), False)
+            del email_data
+        if prefix_ids:
+            result, email_data = mailclient.uid('fetch', build_uid_set(prefix_ids),
+                                                '(UID INTERNALDATE BODY.PEEK[]<0.%d>)' % prefix_size)
+            if result != 'OK':
+                return None
+            for uid, message_data in parse_fetch_response(email_data):
+                if uid not in prefix_ids or not message_data.get('BODY[]<0>'):
+                    continue
+                mails[uid] = (uid, message_data['BODY[]<0>'], get_imap_delivery_time(message_data), False,
+                              sizes[uid], True)
+            del email_data
+        for uid in spool_ids:
+            spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_CHUNK_SIZE)
+            message_data = spool_imap_mail(mailclient, uid, spool, SPOOL_CHUNK_SIZE)
+            if not message_data:
+                spool.close()
+                if message_data is None:
+                    for mail in mails.values():
+                        if hasattr(mail[1], 'close'):
+                            mail[1].close()
+                    return None
+                continue
+            spool.seek(0)
+            mails[uid] = (uid, spool, get_imap_delivery_time(message_data), False, sizes[uid], False)
+        return [mails[uid] for uid in sorted(mails)]
+
+    def imap_delete_emails(self, mailclient, email_ids):
+        """
+        This flags the given mails as deleted with a single STORE and removes them with a single expunge.
+        UID EXPUNGE is used when the server advertises UIDPLUS, so that only these mails get expunged.
+        :param mailclient: IMAP connection with the folder selected
+        :type mailclient: imaplib.IMAP4
+        :param email_ids: UIDs of the mails to be deleted. The list is emptied once they have been expunged.
+        :type email_ids: list
+        """
+        if not email_ids:
+            return
+        uid_set = build_uid_set(email_ids)
+        mailclient.uid('store', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+        if 'UIDPLUS' in mailclient.capabilities:
+            mailclient.uid('expunge', uid_set)
+        else:
+            mailclient.expunge()
+        self.log(EventWriter.DEBUG, "Deleted %d mails from mailbox: %s" % (len(email_ids), self.username))
+        del email_ids[:]
+
+    def parse_email(self, raw_email, partial=False, mail_size=None, truncated=False):
+        """
+        This is the parse stage of the mail pipeline, run by its parse workers. Each worker hands
+        the mail to the parse process pool when parse_processes is set, and waits for the result.
+        Spooled mails are parsed by the worker itself, as a file cannot be sent to another process,
+        and their file is removed once they are parsed.
+        :param raw_email: The mail as fetched, either as bytes (IMAP), as a list of lines (POP3) or spooled to a file
+        :type raw_email: Union[bytes, list, file]
+        :param partial: Whether the mail was fetched without its attachments
+        :type partial: bool
+        :param mail_size: Size of the mail on the server, when it is known
+        :type mail_size: int
+        :param truncated: Whether only the start of the mail was fetched
+        :type truncated: bool
+        :return: Returns a list with the [date, Message-id, mail_message]
+        :rtype: list
+        """
+        arguments = (raw_email, self.include_headers, self.maintain_rfc, self.attach_message_primary,
+                     self.attachment_hashes, self.drop_attachment, partial, self.max_event_size, mail_size, truncated)
+        if not hasattr(raw_email, 'read'):
+            if self.parse_pool is not None:
+                return self.parse_pool.apply(parse_mail, arguments)
+            return parse_mail(*arguments)
+        try:
+            return parse_mail(*arguments)
+        finally:
+            raw_email.close()
+
+    def create_pipeline(self, write):
+        """
+        :return: Returns a MailPipeline with a parse worker for every parse process, if parse_processes is set.
+         Mails are put as (id, raw mail) tuples, followed for IMAP by the delivery time, whether the mail
+         was fetched without its attachments, its size, and whether only its start was fetched.
+        :rtype: MailPipeline
+        """
+        workers = self.parse_processes or PIPELINE_PARSE_THREADS
+        return MailPipeline(lambda mail: self.parse_email(mail[1], *mail[3:]), write,
+                            workers=workers, max_mails=max(PIPELINE_MAX_MAILS, 2 * workers))
+
+    def write_imap_email(self, folder, uidvalidity, delete_ids, indexed_ids, latencies, mail, parsed_email):
+        """
+        This is the write stage of the IMAP mail pipeline, run by its writer thread in the order mails were fetched.
+        :param latencies: Seconds between delivery and write of every written mail, for mails with a delivery time
+        :type latencies: list
+        :param mail: The (uid, raw mail, delivery time, partial) that was fetched
+        :type mail: tuple
+        :param parsed_email: The [date, Message-id, mail_message] returned by parse_email
+        :type parsed_email: list
+        """
+        uid = mail[0]
+        message_time, message_mid, msg = parsed_email
+        if msg is None:
+            self.log(EventWriter.WARN, "Could not parse mail uid {msg_uid}".format(msg_uid=uid))
+            return
+        already_indexed = self.checkpoints.locate_checkpoint(message_mid)
+        if already_indexed and (self.mailbox_cleanup == 'delayed' or self.mailbox_cleanup == 'delete'):
+            delete_ids.append(uid)
+            self.log(EventWriter.DEBUG, "Mail already indexed: %s" % message_mid)
+            # if not already_indexed: then message deletion has been delayed until next run
+        elif not already_indexed:
+            logevent = Event(
+                stanza=self.input_name,
+                data=msg,
+                host=self.mailserver,
+                source="{}/{}".format(self.input_name, folder),
+                time="%.3f" % message_time,
+                done=True,
+                unbroken=True
+            )
+            self.write_event(logevent)
+            self.checkpoints.save_checkpoint(message_mid, [self.username, folder, uidvalidity, uid])
+            indexed_ids.append(uid)
+            if mail[2] is not None:
+                latencies.append(time.time() - mail[2])
+        if self.mailbox_cleanup == 'delete' and uid not in delete_ids:
+            delete_ids.append(uid)
+
+    def save_imap_progress(self, folder, uidvalidity, highest_uid, indexed_ids):
+        """
+        This commits the checkpoints of a batch and then saves the folder sync state. It is run by the
+        writer thread of the mail pipeline once every mail of the batch has been written.
+        """
+        self.checkpoints.commit()
+        if uidvalidity is not None:
+            self.checkpoints.save_folder_cursor(self.username, folder, uidvalidity, highest_uid)
+            if self.mailbox_cleanup == 'delayed':
+                self.checkpoints.save_pending_deletes(self.username, folder, uidvalidity, indexed_ids)
+
+    def connect_imap(self, new_connection=False):
+        """
+        :param new_connection: Opens a new connection, instead of using the connection kept since the previous run
+        :type new_connection: bool
+        :return: Returns an authenticated IMAP connection to the mail server
+        :rtype: imaplib.IMAP4_SSL
+        """
+        if not new_connection:
+            mailclient = self.connections.acquire(self.mailserver, 'IMAP', self.username)
+            if mailclient is not None:
+                self.log(EventWriter.DEBUG, "IMAP - Using the connection kept for %s" % self.username)
+                return mailclient
         credential = self.get_credential()
-        mailclient = imaplib.IMAP4_SSL(self.mailserver)
+        mailclient = self.connections.connect(self.mailserver, 'IMAP', self.username, self.connect_timeout,
+                                              self.read_timeout)
         try:
             # mailclient.debug = 4
             self.log(EventWriter.INFO, "IMAP - Connecting to mailbox as %s" % self.username)
-            mailclient.login(credential.username, credential.clear_password)
+            typ, data = mailclient.login(credential.username, credential.clear_password)
         except imaplib.IMAP4.error:
+            self.connections.discard(mailclient)
             raise MailLoginFailed(self.mailserver, credential.username)
         except (socket.error, SSLError) as e:
+            self.connections.discard(mailclient)
             raise MailConnectionError(e)
-        self.log(EventWriter.INFO, "Listing folders in mailbox=%s" % self.username)
-        # with Capturing() as output:
-        status, imap_list = mailclient.list()
-        if status == 'OK':
-            mail_folder_list = [ensure_str(each_folder).split('"')[-2] for each_folder in imap_list]
-            folders = ','.join(mail_folder_list)
-            self.log(EventWriter.INFO, "Folders found: {}".format(folders))
+        update_imap_capabilities(mailclient, data)
+        if 'COMPRESS=DEFLATE' in mailclient.capabilities:
+            """COMPRESS (RFC 4978) deflates the rest of the session in both directions"""
+            if mailclient.compress():
+                self.log(EventWriter.DEBUG, "IMAP - Compression enabled for %s" % self.username)
+        if 'QRESYNC' in mailclient.capabilities and 'ENABLE' in mailclient.capabilities:
+            """QRESYNC (RFC 7162) reports the mails expunged since a HIGHESTMODSEQ, once it has been enabled"""
+            typ, data = mailclient.enable('QRESYNC')
+            enabled = mailclient.response('ENABLED')[1]
+            mailclient.qresync = typ == 'OK' and any(b'QRESYNC' in (e or b'').upper() for e in enabled)
+        return mailclient
+
+    def imap_status_items(self, mailclient):
+        """
+        :return: Returns the STATUS items read before selecting a folder, with HIGHESTMODSEQ when the server
+         supports CONDSTORE (RFC 7162)
+        :rtype: basestring
+        """
+        if 'CONDSTORE' in mailclient.capabilities or 'QRESYNC' in mailclient.capabilities:
+            return IMAP_STATUS_ITEMS + ' HIGHESTMODSEQ'
+        return IMAP_STATUS_ITEMS
+
+    def imap_vanished_ids(self, mailclient, last_uid, highestmodseq):
+        """
+        This asks a server with QRESYNC enabled which of the mails up to last_uid were expunged since
+        highestmodseq, instead of listing every mail of the folder.
+        :param mailclient: IMAP connection with the folder selected
+        :type mailclient: imaplib.IMAP4
+        :return: Returns the UIDs of the expunged mails, or None if the server did not answer
+        :rtype: list
+        """
+        """Drop the VANISHED responses to expunges made by this run"""
+        mailclient.response('VANISHED')
+        result, _ = mailclient.uid('fetch', '1:%d' % last_uid, '(UID)', '(CHANGEDSINCE %d VANISHED)' % highestmodseq)
+        if result != 'OK':
+            return None
+        vanished_ids = []
+        for vanished in mailclient.response('VANISHED')[1]:
+            if vanished:
+                vanished_ids.extend(parse_uid_set(re.sub(br'^\(EARLIER\)\s*', b'', vanished)))
+        return vanished_ids
+
+    def imap_readonly(self):
+        """
+        :return: Returns whether folders get selected as readonly, which is when no mail gets deleted
+        :rtype: bool
+        """
         if self.mailbox_cleanup == 'delete' or self.mailbox_cleanup == 'delayed':
-            imap_readonly_flag = False
-        else:
-            self.log(EventWriter.INFO, "Accessing mailbox with readonly attribute")
-            imap_readonly_flag = IMAP_READONLY_FLAG
-        # if not self.read_inbox: folder_list = [], else: folder_list = ['inbox']
+            return False
+        return IMAP_READONLY_FLAG
+
+    def stream_imap_emails(self):
+        """
+        :return: This returns a list of the messages retrieved via IMAP
+        :rtype: list
+        """
+        mailclient = self.connect_imap()
+        try:
+            self.log(EventWriter.INFO, "Listing folders in mailbox=%s" % self.username)
+            # with Capturing() as output:
+            list_status = 'LIST-STATUS' in mailclient.capabilities
+            if list_status:
+                """LIST-STATUS (RFC 5819) returns the status of every folder with the listing"""
+                status, imap_list = mailclient.list('""', '* RETURN (STATUS (%s))' % self.imap_status_items(mailclient))
+                folder_statuses = parse_imap_status(mailclient.response('STATUS')[1])
+            else:
+                status, imap_list = mailclient.list()
+                folder_statuses = {}
+            if status == 'OK':
+                mail_folder_list = [ensure_str(each_folder).split('"')[-2] for each_folder in imap_list]
+                folders = ','.join(mail_folder_list)
+                self.log(EventWriter.INFO, "Folders found: {}".format(folders))
+            imap_readonly_flag = self.imap_readonly()
+            if imap_readonly_flag:
+                self.log(EventWriter.INFO, "Accessing mailbox with readonly attribute")
+            # if not self.read_inbox: folder_list = [], else: folder_list = ['inbox']
+            folder_list = ['inbox']
+            folder_list.extend(self.additional_folders)
+            selected = False
+            for each_folder in folder_list:
+                folder_status = folder_statuses.get('INBOX' if each_folder.upper() == 'INBOX' else each_folder)
+                if folder_status is None and not list_status:
+                    typ, data = mailclient.status(each_folder, '(%s)' % self.imap_status_items(mailclient))
+                    if typ == 'OK':
+                        folder_status = next(iter(parse_imap_status(data).values()), None)
+                if folder_status is not None and self.imap_folder_unchanged(each_folder, folder_status):
+                    self.log(EventWriter.DEBUG, "No change in %s/%s since the last run" % (self.username, each_folder))
+                    continue
+                selected = self.stream_imap_folder(mailclient, each_folder, imap_readonly_flag, folder_status)
+            if selected:
+                """CLOSE is only allowed while a folder is selected"""
+                mailclient.close()
+            if mailclient.compression is not None:
+                self.log(EventWriter.INFO, "IMAP compression for %s: %s" % (
+                    self.username, mailclient.compression.summary()))
+                """Counted again for the next run of a kept connection"""
+                mailclient.compression = CompressionStats()
+        except BaseException:
+            """A connection left in an unknown state by an error is logged out instead of kept"""
+            self.connections.discard(mailclient)
+            raise
+        self.connections.release(self.mailserver, 'IMAP', self.username, mailclient)
+
+    def imap_folder_unchanged(self, each_folder, folder_status):
+        """
+        This compares the STATUS of a folder with the one saved at the end of its last full sync. New mails
+        always get a new UID, so the folder has no new mail as long as UIDVALIDITY and UIDNEXT are the same.
+        :param folder_status: Status items of the folder, as returned by parse_imap_status
+        :type folder_status: dict
+        :return: Returns whether the folder can be skipped
+        :rtype: bool
+        """
+        uidvalidity, uidnext, messages, _ = self.checkpoints.load_folder_status(self.username, each_folder)
+        if uidnext is None or 'UIDVALIDITY' not in folder_status or 'UIDNEXT' not in folder_status:
+            return False
+        if uidvalidity != '%d' % folder_status['UIDVALIDITY'] or uidnext != folder_status['UIDNEXT']:
+            return False
+        if self.checkpoint_prune_missing and messages != folder_status.get('MESSAGES'):
+            """Mails were removed from the folder, so its listing needs to be recorded again"""
+            return False
+        if (self.mailbox_cleanup == 'delayed' or self.mailbox_cleanup == 'delete') and folder_status.get('MESSAGES'):
+            """Folders trimmed by delete/delayed only hold mails that still need to be indexed or deleted"""
+            return False
+        return True
+
+    def start_imap_idle(self):
+        """
+        This keeps a thread in IDLE for every folder of the input, and starts again the ones that stopped.
+        """
         folder_list = ['inbox']
         folder_list.extend(self.additional_folders)
         for each_folder in folder_list:
-            mailclient.select(each_folder, readonly=imap_readonly_flag)
-            status, data = mailclient.uid('search', None, 'ALL')
-            mails_retrieved = 0
-            if status == 'OK':
-                email_ids = data[0].split()
-                num_of_messages = len(email_ids)
-                if num_of_messages > 0:
-                    num = 0
-                    while num != num_of_messages:
-                        result, email_data = mailclient.uid('fetch', email_ids[num], '(RFC822)')
-                        if result == 'OK':
-                            raw_email = email_data[0][1]
-                            raw_email = raw_email.decode("ascii", "replace")
-                            message_time, message_mid, msg = email_mime.parse_email(
-                                raw_email,
-                                self.include_headers,
-                                self.maintain_rfc,
-                                self.attach_message_primary,
-                            )
-                            if msg is None:
-                                self.log(EventWriter.WARN, "Could not parse mail num {msg_num}".format(msg_num=num))
-                            else:
-                                if self.drop_attachment:
-                                    msg = drop_attachment_from_event(msg)
-                                if locate_checkpoint(self.checkpoint_dir, message_mid) and (
-                                        self.mailbox_cleanup == 'delayed' or self.mailbox_cleanup == 'delete'):
-                                    mailclient.uid('store', email_ids[num], '+FLAGS', '(\\Deleted)')
-                                    mailclient.expunge()
-                                    self.log(EventWriter.DEBUG, "Mail already indexed: %s" % message_mid)
-                                    # if not locate_checkpoint(...): then message deletion has been delayed until next run
-                                elif not locate_checkpoint(self.checkpoint_dir, message_mid):
-                                    logevent = Event(
-                                        stanza=self.username,
-                                        data=msg,
-                                        host=self.mailserver,
-                                        source="{}/{}".format(self.input_name, each_folder),
-                                        time="%.3f" % message_time,
-                                        done=True,
-                                        unbroken=True
-                                    )
-                                    self.write_event(logevent)
-                                    save_checkpoint(self.checkpoint_dir, message_mid)
-                                    mails_retrieved += 1
-                                if self.mailbox_cleanup == 'delete':
-                                    mailclient.uid('store', email_ids[num], '+FLAGS', '(\\Deleted)')
-                                    mailclient.expunge()
-                        num += 1
-            self.log(EventWriter.INFO,
-                     "Retrieved %d mails from mailbox: %s/%s" % (mails_retrieved, self.username, each_folder))
+            thread = self.idle_threads.get(each_folder)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self.idle_imap_folder, args=(each_folder,),
+                                          name='mail-idle-%s/%s' % (self.username, each_folder))
+                thread.daemon = True
+                thread.start()
+                self.idle_threads[each_folder] = thread
+
+    def idle_imap_folder(self, each_folder):
+        """
+        This indexes the new mails of a folder as soon as the server reports them, on its own connection kept
+        in IDLE. IDLE is issued again before servers drop it after 29 minutes, and the connection is opened
+        again after any error, waiting twice as long after each failed attempt.
+        :param each_folder: Name of the folder
+        :type each_folder: basestring
+        """
+        backoff = IMAP_RECONNECT_BACKOFF_MIN
+        while True:
+            mailclient = None
+            try:
+                mailclient = self.connect_imap(new_connection=True)
+                if 'IDLE' not in mailclient.capabilities:
+                    self.log(EventWriter.WARN, "%s does not support IDLE, polling %s every %d seconds" % (
+                        self.mailserver, self.username, self.interval))
+                    self.imap_idle = False
+                    return
+                self.stream_imap_folder(mailclient, each_folder, self.imap_readonly())
+                backoff = IMAP_RECONNECT_BACKOFF_MIN
+                while True:
+                    if imap_idle(mailclient, IMAP_IDLE_REFRESH):
+                        self.stream_imap_folder(mailclient, each_folder, self.imap_readonly())
+            except Exception as e:
+                self.log(EventWriter.WARN, "IDLE on %s/%s stopped, connecting again in %d seconds: %s" % (
+                    self.username, each_folder, backoff, e))
+            finally:
+                if mailclient is not None:
+                    self.connections.discard(mailclient)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, IMAP_RECONNECT_BACKOFF_MAX)
 
-        mailclient.close()
-        mailclient.logout()
+    def stream_imap_folder(self, mailclient, each_folder, imap_readonly_flag, folder_status=None):
+        """
+        This indexes the new mails of a single IMAP folder. Mails are fetched in batches on this thread,
+        while they are parsed and written by a MailPipeline.
+        :param mailclient: IMAP connection
+        :type mailclient: imaplib.IMAP4
+        :param each_folder: Name of the folder
+        :type each_folder: basestring
+        :param imap_readonly_flag: Whether the folder gets selected as readonly
+        :type imap_readonly_flag: bool
+        :param folder_status: Status items of the folder from before the SELECT, saved once every mail is indexed
+        :type folder_status: dict
+        :return: Returns whether the folder was selected
+        :rtype: bool
+        """
+        typ = mailclient.select(each_folder, readonly=imap_readonly_flag)[0]
+        uidvalidity = get_imap_uidvalidity(mailclient, each_folder)
+        cursor_uidvalidity, last_uid = self.checkpoints.load_folder_cursor(self.username, each_folder)
+        if uidvalidity is None or cursor_uidvalidity != uidvalidity:
+            if cursor_uidvalidity is not None:
+                self.log(EventWriter.INFO, "UIDVALIDITY changed for %s/%s, running a full resync" % (
+                    self.username, each_folder))
+            last_uid = 0
+        highest_uid = last_uid
+        if self.mailbox_cleanup == 'delayed' and uidvalidity is not None:
+            """Delete what the previous run indexed straight from its UIDs, without fetching it again"""
+            pending_uidvalidity, pending_ids = self.checkpoints.load_pending_deletes(self.username, each_folder)
+            if pending_ids and pending_uidvalidity == uidvalidity:
+                self.imap_delete_emails(mailclient, pending_ids)
+            self.checkpoints.save_pending_deletes(self.username, each_folder, uidvalidity, [])
+        if self.mailbox_cleanup == 'delayed' or self.mailbox_cleanup == 'delete' or last_uid == 0:
+            """Folders trimmed by delete/delayed only hold mails that still need to be indexed or deleted"""
+            last_uid = 0
+            search_criteria = 'ALL'
+        else:
+            search_criteria = 'UID %d:*' % (last_uid + 1)
+        status, data = mailclient.uid('search', None, search_criteria)
+        if self.checkpoint_prune_missing and status == 'OK' and uidvalidity is not None:
+            listing = data
+            highestmodseq = self.checkpoints.load_folder_status(self.username, each_folder)[3]
+            vanished_ids = None
+            if search_criteria != 'ALL' and mailclient.qresync and highestmodseq is not None:
+                vanished_ids = self.imap_vanished_ids(mailclient, last_uid, highestmodseq)
+            if vanished_ids is not None:
+                self.checkpoints.record_vanished(self.username, each_folder, uidvalidity, vanished_ids)
+                listing = None
+            elif search_criteria != 'ALL':
+                listing_status, listing = mailclient.uid('search', None, 'ALL')
+                if listing_status != 'OK':
+                    listing = None
+            if listing is not None:
+                self.checkpoints.record_server_listing(self.username, each_folder, uidvalidity,
+                                                       [int(uid) for uid in listing[0].split()])
+        """delete_ids and indexed_ids are filled by the writer thread, and only read here once it is idle"""
+        delete_ids = []
+        indexed_ids = []
+        latencies = []
+        synced = False
+        if status == 'OK':
+            pipeline = self.create_pipeline(functools.partial(
+                self.write_imap_email, each_folder, uidvalidity, delete_ids, indexed_ids, latencies))
+            try:
+                """UID n:* always matches the highest UID in the folder, even if it is lower than n"""
+                email_ids = [int(uid) for uid in data[0].split() if int(uid) > last_uid]
+                for batch_start in range(0, len(email_ids), self.fetch_batch_size):
+                    batch = email_ids[batch_start:batch_start + self.fetch_batch_size]
+                    highest_uid = max(highest_uid, batch[-1])
+                    fetch_ids = batch
+                    structures = {}
+                    sizes = {}
+                    if not self.attach_message_primary:
+                        """The indexed Message-ID is the one of the attached mail when attach_message_primary is set"""
+                        fetch_ids, known_ids = self.imap_header_dedup(
+                            mailclient, batch, structures if self.imap_partial_fetch() else None,
+                            sizes)
+                        for uid in known_ids:
+                            self.log(EventWriter.DEBUG, "Mail already indexed: uid %d" % uid)
+                            if self.mailbox_cleanup == 'delayed' or self.mailbox_cleanup == 'delete':
+                                delete_ids.append(uid)
+                    if fetch_ids:
+                        mails = self.imap_fetch_mails(mailclient, fetch_ids, structures, sizes)
+                        if mails is None:
+                            self.log(EventWriter.WARN, "Could not fetch mails %s from %s/%s" % (
+                                build_uid_set(fetch_ids), self.username, each_folder))
+                            break
+                        for mail in mails:
+                            """Spooled mails only hold a chunk in memory until they are parsed"""
+                            pipeline.put(mail, SPOOL_CHUNK_SIZE if hasattr(mail[1], 'read') else len(mail[1]))
+                        del mails
+                    pipeline.call(functools.partial(
+                        self.save_imap_progress, each_folder, uidvalidity, highest_uid, indexed_ids))
+                    if len(delete_ids) >= MAX_EXPUNGE_COUNT:
+                        pipeline.join()
+                        self.imap_delete_emails(mailclient, delete_ids)
+                else:
+                    synced = True
+                pipeline.join()
+            finally:
+                pipeline.close()
+                self.log(EventWriter.DEBUG, "Mail pipeline for %s/%s - %s" % (
+                    self.username, each_folder, pipeline.summary()))
+            self.imap_delete_emails(mailclient, delete_ids)
+        if synced and folder_status and uidvalidity is not None and \
+                '%d' % folder_status.get('UIDVALIDITY', -1) == uidvalidity:
+            """Mails delivered since the STATUS have a UID from its UIDNEXT on, so the next run will see them"""
+            """HIGHESTMODSEQ is where the next run asks for expunged mails, so it needs every mail listed until then"""
+            highestmodseq = folder_status.get('HIGHESTMODSEQ') if self.checkpoint_prune_missing else None
+            self.checkpoints.save_folder_cursor(self.username, each_folder, uidvalidity, highest_uid,
+                                                folder_status.get('UIDNEXT'), folder_status.get('MESSAGES'),
+                                                highestmodseq)
+        self.log(EventWriter.INFO,
+                 "Retrieved %d mails from mailbox: %s/%s" % (len(indexed_ids), self.username, each_folder))
+        if latencies:
+            """Polled inputs add up to an interval of latency by design, which is only worth reporting for IDLE"""
+            self.log(EventWriter.INFO if self.imap_idle else EventWriter.DEBUG,
+                     "Delivery to index latency for %s/%s: avg %.1fs max %.1fs" % (
+                         self.username, each_folder, sum(latencies) / len(latencies), max(latencies)))
+        return typ == 'OK'
+
+    def write_pop_email(self, uidls, indexed_uidls, new_uidls, delete_nums, mail, parsed_email):
+        """
+        This is the write stage of the POP3 mail pipeline, run by its writer thread in the order mails were fetched.
+        :param mail: The (message number, lines or spooled file) that were fetched
+        :type mail: tuple
+        :param parsed_email: The [date, Message-id, mail_message] returned by parse_email
+        :type parsed_email: list
+        """
+        num = mail[0]
+        message_time, message_mid, msg = parsed_email
+        if msg is None:
+            self.log(EventWriter.WARN, "Could not parse mail num {msg_num}".format(msg_num=num))
+        elif not self.checkpoints.locate_checkpoint(message_mid):
+            """index the mail if it is readonly or if the mail will be deleted"""
+            logevent = Event(
+                stanza=self.input_name,
+                data=msg,
+                host=self.mailserver,
+                source=self.input_name,
+                time="%.3f" % message_time,
+                done=True,
+                unbroken=True
+            )
+            self.write_event(logevent)
+            self.checkpoints.save_checkpoint(message_mid, [self.username, 'POP3', None, uidls.get(num)])
+            if num in uidls:
+                indexed_uidls.add(uidls[num])
+            new_uidls.append(uidls.get(num))
+            if self.mailbox_cleanup == 'delete':
+                delete_nums.append(num)
+        else:
+            if num in uidls:
+                indexed_uidls.add(uidls[num])
+            if self.mailbox_cleanup == 'delayed' or self.mailbox_cleanup == 'delete':
+                self.log(EventWriter.DEBUG, "Found a mail that had already been indexed: %s" % message_mid)
+                delete_nums.append(num)
 
     def stream_pop_emails(self):
         """
@@ -338,60 +981,122 @@ class Mail(Script):
         """
         credential = self.get_credential()
         try:
-            mailclient = poplib.POP3_SSL(host=self.mailserver)
+            mailclient = self.connections.connect(self.mailserver, 'POP3', self.username, self.connect_timeout,
+                                                  self.read_timeout)
         except (socket.error, SSLError) as e:
             raise MailConnectionError(e)
         except poplib.error_proto as e:
             """Some kind of poplib exception: EOF or other"""
             raise MailProtocolError(str(e))
         try:
-            mailclient.set_debuglevel(2)
-            self.log(EventWriter.INFO, "POP3 - Connecting to mailbox as %s" % self.username)
-            self.log(EventWriter.INFO, "POP3 debug: %s" % mailclient.user(credential.username))
-            mailclient.set_debuglevel(1)
-            self.log(EventWriter.INFO, "POP3 debug: %s" % mailclient.pass_(credential.clear_password))
-        except poplib.error_proto:
-            raise MailLoginFailed(self.mailserver, credential.username)
-        num = 0
-        mails_retrieved = 0
-        (num_of_messages, totalsize) = mailclient.stat()
-        if num_of_messages > 0:
-            while num != num_of_messages:
-                num += 1
-                (header, lines, octets) = mailclient.retr(num)
-                # raw_email = '\n'.join(lines)
-                raw_email = '\n'.join(s.decode("utf-8", "ignore") if isinstance(s,  binary_type) else s for s in lines)
-                message_time, message_mid, msg = email_mime.parse_email(
-                    raw_email,
-                    self.include_headers,
-                    self.maintain_rfc,
-                    self.attach_message_primary,
-                )
-                if msg is None:
-                    self.log(EventWriter.WARN, "Could not parse mail num {msg_num}".format(msg_num=num))
-                else:
-                    if not locate_checkpoint(self.checkpoint_dir, message_mid):
-                        """index the mail if it is readonly or if the mail will be deleted"""
-                        logevent = Event(
-                            stanza=self.username,
-                            data=msg,
-                            host=self.mailserver,
-                            source=self.input_name,
-                            time="%.3f" % message_time,
-                            done=True,
-                            unbroken=True
-                        )
-                        self.write_event(logevent)
-                        save_checkpoint(self.checkpoint_dir, message_mid)
-                        mails_retrieved += 1
-                        if self.mailbox_cleanup == 'delete':
-                            mailclient.dele(num)
-                    elif locate_checkpoint(self.checkpoint_dir, message_mid) and (
-                            self.mailbox_cleanup == 'delayed' or self.mailbox_cleanup == 'delete'):
-                        self.log(EventWriter.DEBUG, "Found a mail that had already been indexed: %s" % message_mid)
-                        mailclient.dele(num)
+            try:
+                mailclient.set_debuglevel(2)
+                self.log(EventWriter.INFO, "POP3 - Connecting to mailbox as %s" % self.username)
+                self.log(EventWriter.INFO, "POP3 debug: %s" % mailclient.user(credential.username))
+                mailclient.set_debuglevel(1)
+                self.log(EventWriter.INFO, "POP3 debug: %s" % mailclient.pass_(credential.clear_password))
+            except poplib.error_proto:
+                raise MailLoginFailed(self.mailserver, credential.username)
+            num = 0
+            fetched = 0
+            """TOP is optional in POP3, and attached mails carry their own Message-ID"""
+            header_dedup = not self.attach_message_primary
+            (num_of_messages, totalsize) = mailclient.stat()
+            uidls = {}
+            sizes = {}
+            if num_of_messages > 0:
+                try:
+                    uidls = get_pop_uidls(mailclient)
+                except poplib.error_proto as e:
+                    self.log(EventWriter.INFO, "POP3 UIDL not supported, checking every mail: %s" % e)
+                if self.spool_threshold_mb and totalsize > self.spool_threshold_mb * 1024 * 1024:
+                    """No mail is larger than the mailbox"""
+                    sizes = get_pop_sizes(mailclient)
+            indexed_uidls = self.checkpoints.load_pop_uidls(self.username)
+            if self.checkpoint_prune_missing and (uidls or num_of_messages == 0):
+                self.checkpoints.record_server_listing(self.username, 'POP3', None, uidls.values())
+            """new_uidls and delete_nums are filled by the writer thread, and only read here once it is idle"""
+            new_uidls = []
+            delete_nums = []
+            deleted_nums = set()
+            if self.mailbox_cleanup == 'delayed' and uidls:
+                """Delete what the previous run indexed straight from its UIDLs, without fetching it again"""
+                pending_uidvalidity, pending_uidls = self.checkpoints.load_pending_deletes(self.username, 'POP3')
+                pending_uidls = set(pending_uidls)
+                for msg_num, uidl in uidls.items():
+                    if uidl in pending_uidls:
+                        mailclient.dele(msg_num)
+                        deleted_nums.add(msg_num)
+            if num_of_messages > 0:
+                pipeline = self.create_pipeline(
+                    functools.partial(self.write_pop_email, uidls, indexed_uidls, new_uidls, delete_nums))
+                try:
+                    while num != num_of_messages:
+                        num += 1
+                        if num in deleted_nums:
+                            continue
+                        if uidls.get(num) in indexed_uidls:
+                            if self.mailbox_cleanup == 'delayed' or self.mailbox_cleanup == 'delete':
+                                mailclient.dele(num)
+                                deleted_nums.add(num)
+                            continue
+                        if header_dedup:
+                            try:
+                                (header, lines, octets) = mailclient.top(num, 0)
+                            except poplib.error_proto as e:
+                                self.log(EventWriter.INFO, "POP3 TOP not supported, fetching full mails: %s" % e)
+                                header_dedup = False
+                            else:
+                                message_time, message_mid = email_mime.parse_email_header(lines)
+                                if message_mid and self.checkpoints.locate_checkpoint(message_mid):
+                                    self.log(EventWriter.DEBUG,
+                                             "Found a mail that had already been indexed: %s" % message_mid)
+                                    if num in uidls:
+                                        indexed_uidls.add(uidls[num])
+                                    if self.mailbox_cleanup == 'delayed' or self.mailbox_cleanup == 'delete':
+                                        mailclient.dele(num)
+                                        deleted_nums.add(num)
+                                    continue
+                        if sizes.get(num, 0) > self.spool_threshold_mb * 1024 * 1024:
+                            spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_CHUNK_SIZE)
+                            try:
+                                spool_pop_mail(mailclient, num, spool)
+                            except Exception:
+                                spool.close()
+                                raise
+                            spool.seek(0)
+                            pipeline.put((num, spool), SPOOL_CHUNK_SIZE)
+                        else:
+                            (header, lines, octets) = mailclient.retr(num)
+                            pipeline.put((num, lines), octets)
+                        fetched += 1
+                        if fetched % self.fetch_batch_size == 0:
+                            """As for IMAP, a run that fails keeps the checkpoints of the batches it wrote"""
+                            pipeline.call(self.checkpoints.commit)
+                    pipeline.join()
+                finally:
+                    pipeline.close()
+                    self.log(EventWriter.DEBUG, "Mail pipeline for %s - %s" % (self.username, pipeline.summary()))
+                """POP3 deletions only take effect at QUIT, so deleting written mails at the end changes nothing"""
+                for msg_num in delete_nums:
+                    mailclient.dele(msg_num)
+                    deleted_nums.add(msg_num)
+            self.connections.save_session(self.mailserver, 'POP3', mailclient)
             mailclient.quit()
-            self.log(EventWriter.INFO, "Retrieved %d mails from mailbox: %s" % (mails_retrieved, self.username))
+        except BaseException:
+            """Closing without QUIT leaves the mailbox as it was, and frees the connection slot"""
+            self.connections.discard(mailclient)
+            raise
+        if num_of_messages > 0:
+            if uidls:
+                """Only UIDLs still on the server are kept, which bounds the size of the map"""
+                self.checkpoints.save_pop_uidls(self.username, [
+                    uidl for msg_num, uidl in uidls.items() if uidl in indexed_uidls and msg_num not in deleted_nums])
+            if self.mailbox_cleanup == 'delayed':
+                """POP3 deletions only take effect once QUIT succeeds"""
+                self.checkpoints.save_pending_deletes(self.username, 'POP3', None,
+                                                      [uidl for uidl in new_uidls if uidl is not None])
+            self.log(EventWriter.INFO, "Retrieved %d mails from mailbox: %s" % (len(new_uidls), self.username))
 
     def stream_events(self, inputs, ew):
         try:
@@ -403,9 +1108,9 @@ class Mail(Script):
         """This function handles all the action: splunk calls this modular input
         without arguments, streams XML describing the inputs to stdin, and waits
         for XML on stdout describing events.
-        If you set use_single_instance to True on the scheme in get_scheme, it
-        will pass all the instances of this input to a single instance of this
-        script.
+        As use_single_instance is set on the scheme in get_scheme, it passes all
+        the instances of this input to a single instance of this script, which
+        keeps running them at their own intervals.
         :param inputs: an InputDefinition object
         :type inputs: InputDefinition
         :param ew: an EventWriter object
@@ -413,9 +1118,67 @@ class Mail(Script):
         """
         self.log = ew.log
         self.write_event = ew.write_event
-        input_list = inputs.inputs.popitem()
-        """This runs just once since the default self.use_single_instance = False"""
-        input_name, input_item = input_list
+        if not SINGLE_INSTANCE_MODE:
+            """This runs just once, as splunk starts the script for every input at every interval"""
+            input_name, input_item = inputs.inputs.popitem()
+            self.configure(input_name, input_item, inputs.metadata['checkpoint_dir'])
+            self.run_input()
+            return
+        write_lock = threading.Lock()
+
+        def write_event(event):
+            """Events of all inputs are written to the same stream, one at a time"""
+            with write_lock:
+                ew.write_event(event)
+
+        mail_inputs = []
+        for input_name, input_item in inputs.inputs.items():
+            mail_input = Mail()
+            mail_input._input_definition = self._input_definition
+            mail_input.log = ew.log
+            mail_input.write_event = write_event
+            try:
+                mail_input.configure(input_name, input_item, inputs.metadata['checkpoint_dir'])
+            except Exception as e:
+                self.log(EventWriter.ERROR, "Could not start input %s: %s" % (input_name, e))
+                continue
+            mail_inputs.append(mail_input)
+        if not mail_inputs:
+            return
+        """The pool and the checkpoint store are shared by all inputs"""
+        parse_processes = max(mail_input.parse_processes for mail_input in mail_inputs)
+        parse_pool = None
+        if parse_processes:
+            parse_pool = create_parse_pool(parse_processes)
+        checkpoints = CheckpointStore(inputs.metadata['checkpoint_dir'])
+        connections = ConnectionManager(keep_alive=True)
+        scheduler = InputScheduler(ew.log)
+        for mail_input in mail_inputs:
+            mail_input.parse_pool = parse_pool if mail_input.parse_processes else None
+            mail_input.checkpoints = checkpoints
+            mail_input.connections = connections
+            scheduler.add(mail_input.input_name, mail_input.interval, mail_input.run_scheduled_input)
+        self.log(EventWriter.INFO, "Running %d inputs, at most %d at a time" % (
+            len(mail_inputs), MAX_CONCURRENT_INPUTS))
+        try:
+            scheduler.run()
+        finally:
+            connections.close()
+            checkpoints.close()
+            if parse_pool is not None:
+                parse_pool.close()
+                parse_pool.join()
+
+    def configure(self, input_name, input_item, checkpoint_dir):
+        """
+        This reads the configuration of an input stanza.
+        :param input_name: Name of the stanza, as mail://<email address>
+        :type input_name: basestring
+        :param input_item: Parameters of the stanza
+        :type input_item: dict
+        :param checkpoint_dir: Checkpoint directory of the modular input
+        :type checkpoint_dir: basestring
+        """
         self.input_name = input_name
         self.mailserver = input_item["mailserver"]
         self.username = input_name.split("://")[1]
@@ -446,21 +1209,119 @@ class Mail(Script):
             self.drop_attachment = bool_variable(input_item['drop_attachment'])
         else:
             self.drop_attachment = DEFAULT_DROP_ATTACHMENT
-        self.checkpoint_dir = inputs.metadata['checkpoint_dir']
+        if 'fetch_batch_size' in input_item.keys():
+            self.fetch_batch_size = int(input_item['fetch_batch_size'])
+        else:
+            self.fetch_batch_size = MAX_FETCH_COUNT
+        if 'checkpoint_retention_days' in input_item.keys():
+            self.checkpoint_retention_days = int(input_item['checkpoint_retention_days'])
+        else:
+            self.checkpoint_retention_days = DEFAULT_CHECKPOINT_RETENTION_DAYS
+        if 'checkpoint_prune_missing' in input_item.keys():
+            self.checkpoint_prune_missing = bool_variable(input_item['checkpoint_prune_missing'])
+        else:
+            self.checkpoint_prune_missing = DEFAULT_CHECKPOINT_PRUNE_MISSING
+        if 'attachment_hashes' in input_item.keys():
+            self.attachment_hashes = [] if input_item['attachment_hashes'] == 'none' else \
+                input_item['attachment_hashes'].split(',')
+        else:
+            self.attachment_hashes = DEFAULT_ATTACHMENT_HASHES.split(',')
+        if 'parse_processes' in input_item.keys():
+            self.parse_processes = int(input_item['parse_processes'])
+        else:
+            self.parse_processes = DEFAULT_PARSE_PROCESSES
+        if 'imap_idle' in input_item.keys():
+            self.imap_idle = bool_variable(input_item['imap_idle'])
+        else:
+            self.imap_idle = DEFAULT_IMAP_IDLE
+        if 'connect_timeout' in input_item.keys():
+            self.connect_timeout = int(input_item['connect_timeout'])
+        else:
+            self.connect_timeout = DEFAULT_CONNECT_TIMEOUT
+        if 'read_timeout' in input_item.keys():
+            self.read_timeout = int(input_item['read_timeout'])
+        else:
+            self.read_timeout = DEFAULT_READ_TIMEOUT
+        if 'spool_threshold_mb' in input_item.keys():
+            self.spool_threshold_mb = int(input_item['spool_threshold_mb'])
+        else:
+            self.spool_threshold_mb = DEFAULT_SPOOL_THRESHOLD_MB
+        if 'max_event_size' in input_item.keys():
+            self.max_event_size = int(input_item['max_event_size'])
+        else:
+            self.max_event_size = DEFAULT_MAX_EVENT_SIZE
+        try:
+            self.interval = int(input_item.get('interval') or DEFAULT_INPUT_INTERVAL)
+        except ValueError:
+            self.log(EventWriter.WARN, "Cron schedules are not supported for %s, running it every %d seconds" % (
+                input_name, DEFAULT_INPUT_INTERVAL))
+            self.interval = DEFAULT_INPUT_INTERVAL
+        self.checkpoint_dir = checkpoint_dir
         match = re.match(REGEX_EMAIL, self.username)
         if not match:
-            ew.log(EventWriter.ERROR, "Modular input name must be an email address")
+            self.log(EventWriter.ERROR, "Modular input name must be an email address")
             self.disable_input()
             raise MailExceptionStanzaNotEmail(self.username)
+
+    def run_input(self):
+        """
+        This collects the mails of the configured input once. The parse pool, the checkpoint store and the
+        connection manager are only opened (and closed) here if they have not been set up for all inputs
+        by the single instance.
+        """
         self.save_password()
-        if "POP3" == self.protocol:
-            self.stream_pop_emails()
-        elif "IMAP" == self.protocol:
-            self.stream_imap_emails()
-        else:
-            ew.log(EventWriter.ERROR, "Protocol must be either POP3 or IMAP")
-            self.disable_input()
-            raise MailExceptionInvalidProtocol
+        own_parse_pool = self.parse_processes and self.parse_pool is None
+        if own_parse_pool:
+            self.parse_pool = create_parse_pool(self.parse_processes)
+        own_checkpoints = self.checkpoints is None
+        if own_checkpoints:
+            self.checkpoints = CheckpointStore(self.checkpoint_dir)
+        own_connections = self.connections is None
+        if own_connections:
+            self.connections = ConnectionManager()
+        try:
+            if "POP3" == self.protocol:
+                self.stream_pop_emails()
+            elif "IMAP" == self.protocol and self.imap_idle and SINGLE_INSTANCE_MODE:
+                """The IDLE threads keep running between runs, which only check on them and compact checkpoints"""
+                self.start_imap_idle()
+            elif "IMAP" == self.protocol:
+                self.stream_imap_emails()
+            else:
+                self.log(EventWriter.ERROR, "Protocol must be either POP3 or IMAP")
+                self.disable_input()
+                raise MailExceptionInvalidProtocol
+            removed = self.checkpoints.compact(self.username, self.checkpoint_retention_days,
+                                               CHECKPOINT_COMPACTION_BUDGET)
+            if removed:
+                self.log(EventWriter.INFO, "Removed %d checkpoints for mailbox: %s" % (removed, self.username))
+        finally:
+            self.log(EventWriter.INFO, "Connections to %s for %s: %s" % (
+                self.mailserver, self.username,
+                self.connections.get_stats(self.mailserver, self.protocol, self.username).summary()))
+            if own_connections:
+                self.connections.close()
+                self.connections = None
+            if own_checkpoints:
+                self.checkpoints.close()
+                self.checkpoints = None
+            else:
+                self.checkpoints.commit()
+            if own_parse_pool:
+                self.parse_pool.close()
+                self.parse_pool.join()
+                self.parse_pool = None
+
+    def run_scheduled_input(self):
+        """
+        This is run by the scheduler of the single instance at every interval of the input.
+        Errors are logged, and the input runs again at its next interval.
+        """
+        try:
+            self.run_input()
+        except Exception as e:
+            self.log(EventWriter.ERROR, "Exception collecting mails for %s:  %s\n%s" % (
+                self.input_name, e, traceback.format_exc()))
 
 
 if __name__ == "__main__":
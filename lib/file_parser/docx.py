@@ -20,7 +20,7 @@ def parse_docx(part, part_name):
     :rtype: list
     """
     if part_name == EMAIL_PART:
-        decoded_payload = part.get_payload(decode=True)
+        decoded_payload = get_decoded_payload(part)
         zip_name = part.get_filename() or ''
     else:
         decoded_payload = part
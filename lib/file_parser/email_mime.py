@@ -6,25 +6,67 @@ import email
 import re
 import os
 from . import zip
-import hashlib
 import quopri
 # noinspection PyUnresolvedReferences
 from base64 import b64decode
 try:
-    from email.parser import Parser
+    from email.feedparser import BytesFeedParser
 except ImportError:
     # Python 2
-    from email.Parser import Parser
+    from email.FeedParser import FeedParser as BytesFeedParser
 
 from email.utils import mktime_tz, parsedate_tz
 from .utils import *
 
+FEED_CHUNK_SIZE = 65536
+FEED_CHUNK_LINES = 1024
+LEADING_WHITESPACE = re.compile(br'\s*')
 
-def parse_email(email_as_string, include_headers, maintain_rfc, attach_message_primary):
+
+def message_from_raw(raw_email):
+    """
+    This function builds an email message object straight from the mail as it was fetched, without
+    decoding it to a string first. Bytes are fed to the parser in chunks, so the only full copy made
+    is the one held by the resulting message. Bytes that are not ascii are kept as surrogate escapes
+    by the parser, and are turned back into the original bytes when payloads are decoded.
+    Large mails spooled to a file are read from it in the same chunks.
+    :param raw_email: This represents the email as bytes (IMAP), a list of lines (POP3), a binary file or a string
+    :type raw_email: bytes or list or file or basestring
+    :return: Returns an email message object, or None if nothing could be parsed
+      :rtype: email message object
+    """
+    if isinstance(raw_email, text_type):
+        return email.message_from_string(raw_email.strip()) or None
+    parser = BytesFeedParser()
+    if isinstance(raw_email, binary_type):
+        start = LEADING_WHITESPACE.match(raw_email).end()
+        for offset in range(start, len(raw_email), FEED_CHUNK_SIZE):
+            parser.feed(raw_email[offset:offset + FEED_CHUNK_SIZE])
+    elif hasattr(raw_email, 'read'):
+        started = False
+        chunk = raw_email.read(FEED_CHUNK_SIZE)
+        while chunk:
+            if not started:
+                chunk = chunk[LEADING_WHITESPACE.match(chunk).end():]
+                started = bool(chunk)
+            parser.feed(chunk)
+            chunk = raw_email.read(FEED_CHUNK_SIZE)
+    else:
+        lines = list(raw_email)
+        start = 0
+        while start < len(lines) and not lines[start].strip():
+            start += 1
+        for offset in range(start, len(lines), FEED_CHUNK_LINES):
+            parser.feed(b'\n'.join(lines[offset:offset + FEED_CHUNK_LINES]) + b'\n')
+    return parser.close() or None
+
+
+def parse_email(email_as_string, include_headers, maintain_rfc, attach_message_primary,
+                hash_algorithms=DEFAULT_HASH_ALGORITHMS, partial=False, max_size=0):
     """
     This function parses an email and returns an array with different parts of the message.
-    :param email_as_string: This represents the email in a bytearray to be processed
-    :type email_as_string: basestring
+    :param email_as_string: This represents the email to be processed, as accepted by message_from_raw
+    :type email_as_string: bytes or list or file or basestring
     :param include_headers: This parameter specifies if all headers should be included.
     :type include_headers: bool
     :param maintain_rfc: This parameter specifies if RFC format for email stays intact
@@ -32,26 +74,44 @@ def parse_email(email_as_string, include_headers, maintain_rfc, attach_message_p
     :param attach_message_primary: This parameter specifies if first attached email should
       be used as the message for indexing instead of the carrier email
     :type attach_message_primary: bool
+    :param hash_algorithms: This lists the digests computed for every attachment
+    :type hash_algorithms: Union[list, tuple]
+    :param partial: This specifies if the email was rebuilt from its text parts only, in which case
+      the parts that were not fetched are represented by their name, type and size
+    :type partial: bool
+    :param max_size: Once this many characters have been extracted, the remaining parts are not decoded.
+      The event is cut to size afterwards. 0 extracts every part.
+    :type max_size: int
     :return: Returns a list with the [date, Message-id, mail_message]
       :rtype: list
     """
-    message = email.message_from_string(email_as_string.strip()) or None
+    message = message_from_raw(email_as_string)
     if message is None:
         return [None, None, None]
     if attach_message_primary:
         message = change_primary_message(message)   
     if maintain_rfc:
-        index_mail = maintain_rfc_parse(message)
+        index_mail = maintain_rfc_parse(message, hash_algorithms)
     else:
-        mailheaders = Parser().parsestr(message.as_string(), True)
-        headers = ["%s: %s" % (k, getheader(v)) for k, v in mailheaders.items() if k in MAIN_HEADERS]
-        if include_headers:
-            other_headers = ["%s: %s" % (k, getheader(v)) for k, v in mailheaders.items() if k not in MAIN_HEADERS]
-            headers.extend(other_headers)
+        headers = []
+        other_headers = []
+        for k, v in message.items():
+            if k in MAIN_HEADERS:
+                headers.append("%s: %s" % (k, getheader(v)))
+            elif include_headers:
+                other_headers.append("%s: %s" % (k, getheader(v)))
+        headers.extend(other_headers)
         body = []
         if message.is_multipart():
             part_number = 1
+            extracted = sum(len(header) for header in headers)
+            counted = 0
             for part in message.walk():
+                extracted += sum(len(s) for s in body[counted:])
+                counted = len(body)
+                if max_size and extracted >= max_size:
+                    """Whatever follows would be cut from the event, so it is not decoded"""
+                    break
                 content_type = part.get_content_type()
                 content_disposition = part.get('Content-Disposition')
                 if content_type in ['multipart/alternative', 'multipart/mixed']:
@@ -59,9 +119,19 @@ def parse_email(email_as_string, include_headers, maintain_rfc, attach_message_p
                     body.append("Multipart envelope header: %s" % str(part.get_payload(decode=True)))
                     continue
                 body.append("#START_OF_MULTIPART_%d" % part_number)
+                if partial and part.get(SKIPPED_PART_HEADER) is not None:
+                    body.append("#SKIPPED_ATTACHMENT: file_name = %s - type = %s ; size = %s" % (
+                        part.get_filename(), content_type, part.get(SKIPPED_PART_HEADER)))
+                    body.append("#END_OF_MULTIPART_%d" % part_number)
+                    part_number += 1
+                    continue
                 extension = str(os.path.splitext(part.get_filename() or '')[1]).lower()
-                if extension in TEXT_FILE_EXTENSIONS or content_type in SUPPORTED_CONTENT_TYPES or \
-                   part.get_content_maintype() == 'text' or extension in ZIP_EXTENSIONS:
+                supported = extension in TEXT_FILE_EXTENSIONS or content_type in SUPPORTED_CONTENT_TYPES or \
+                    part.get_content_maintype() == 'text' or extension in ZIP_EXTENSIONS
+                if part.get_filename() or not supported:
+                    # Kept outside of the attachment markers, so that they survive drop_attachment
+                    body.extend("%s = %s" % digest for digest in get_payload_hashes(part, hash_algorithms))
+                if supported:
                     if part.get_filename():
                         body.append("#BEGIN_ATTACHMENT: %s" % str(part.get_filename()))
                         if extension in ZIP_EXTENSIONS:
@@ -82,8 +152,35 @@ def parse_email(email_as_string, include_headers, maintain_rfc, attach_message_p
         mail_for_index = []
         mail_for_index.extend(headers + body)
         index_mail = '\n'.join(s.decode('utf-8', 'ignore') if isinstance(s,  binary_type) else s for s in mail_for_index)
-    message_time = float(mktime_tz(parsedate_tz(message['Date'])))
-    return [message_time, message['Message-ID'], index_mail]
+    message_time = float(mktime_tz(parsedate_tz(header_text(message, 'Date'))))
+    return [message_time, header_text(message, 'Message-ID'), replace_surrogates(index_mail)]
+
+def parse_email_header(header_as_string):
+    """
+    This function parses only the header section of an email, as returned by a header-only fetch,
+    so that it can be checked against checkpoints before the body is downloaded.
+    :param header_as_string: This represents the header section of an email, as accepted by message_from_raw
+    :type header_as_string: bytes or list or basestring
+    :return: Returns a list with the [date, Message-id], using None for missing or invalid values
+      :rtype: list
+    """
+    message = message_from_raw(header_as_string)
+    if message is None:
+        return [None, None]
+    message_date = parsedate_tz(header_text(message, 'Date')) if message['Date'] else None
+    message_time = float(mktime_tz(message_date)) if message_date else None
+    return [message_time, header_text(message, 'Message-ID')]
+
+
+def header_text(message, name):
+    """
+    Returns a header as a string. Headers holding 8-bit bytes are returned by the parser as Header objects,
+    so these are decoded here the same way they are when indexed.
+    """
+    value = message[name]
+    if value is None or isinstance(value, text_type):
+        return value
+    return getheader(value)
 
 def change_primary_message(message):
     """
@@ -101,23 +198,41 @@ def change_primary_message(message):
             return i.get_payload()[0]
         elif i.get_content_subtype()=='octet-stream' and i.get_filename().lower().endswith('.eml'):
             if i['Content-Transfer-Encoding'].lower()=='base64': 
-                return email.message_from_string(b64decode(i.get_payload()))
+                return email.message_from_bytes(b64decode(i.get_payload()))
             else:
                 return email.message_from_string(i.get_payload())
 
-def maintain_rfc_parse(message):
+def message_as_bytes(message):
+    """
+    This serialises a message or part as bytes. Messages parsed from bytes turn their surrogate escapes back into
+    the original bytes, while messages parsed from a string can hold characters that are not ascii, which
+    as_bytes() cannot write. Those are written as utf-8.
+    :param message: This represents the email message or part to be serialised.
+    :type message: email message object
+    :return: Returns the message as bytes
+      :rtype: bytes
+    """
+    try:
+        return message.as_bytes()
+    except UnicodeEncodeError:
+        return message.as_string().encode('utf-8', 'surrogateescape')
+
+
+def maintain_rfc_parse(message, hash_algorithms=DEFAULT_HASH_ALGORITHMS):
     """
     This function parses an email and returns an array with different parts of the message
     but leaves the email still RFC compliant so that it works with Mail-Parser Plus app.
     Attachment headers are left in tact.
     :param message: This represents the email to be checked for attached email.
     :type message: email message object
+    :param hash_algorithms: This lists the digests computed for every unsupported attachment
+    :type hash_algorithms: Union[list, tuple]
     :return: Returns a email message formatted as a string
       :rtype: str
     """
     if not message.is_multipart():
         reformatted_message = quopri.decodestring(
-                                message.as_string().encode('ascii', 'ignore')
+                                message_as_bytes(message)
                             ).decode("utf-8", 'ignore')
         return reformatted_message
     boundary = message.get_boundary()
@@ -127,32 +242,24 @@ def maintain_rfc_parse(message):
         extension = str(os.path.splitext(i.get_filename() or '')[1]).lower()
         if extension in TEXT_FILE_EXTENSIONS or content_type in SUPPORTED_CONTENT_TYPES or \
            i.get_content_maintype() == 'text':
-            text_content = i.as_string().encode('ascii', 'ignore')
+            text_content = message_as_bytes(i)
             text_content = quopri.decodestring(text_content).decode("utf-8", 'ignore')
             new_payload += '\n' + text_content
         else:
             replace = re.sub(r'(?:\n\n)[\s\S]+',r'\n\n#UNSUPPORTED_ATTACHMENT:',i.as_string())
             filename = i.get_filename()
             charset = i.get_content_charset()
-            try:
-                md5 = hashlib.md5(i.get_payload(None,True)).hexdigest()
-                sha256 = hashlib.sha256(i.get_payload(None,True)).hexdigest()
-            except:
-                md5 = ''
-                sha256 = ''
             replace_string = """
 file_name = %(filename)s
 type = %(content_type)s
 charset = %(charset)s
-md5 = %(md5)s
-sha256 = %(sha256)s
+%(hashes)s
 """
             metadata = replace_string % dict(
                 content_type=content_type, 
                 filename=filename, 
                 charset=charset,
-                md5=md5,
-                sha256=sha256,
+                hashes='\n'.join("%s = %s" % digest for digest in get_payload_hashes(i, hash_algorithms)),
             )
             new_payload += '\n' \
                 + replace \
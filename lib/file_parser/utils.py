@@ -3,6 +3,8 @@ This includes common functions that are required when dealing with mails
 """
 from __future__ import unicode_literals
 
+import re
+import hashlib
 from email.header import decode_header
 from six import text_type, binary_type
 
@@ -14,6 +16,12 @@ SUPPORTED_CONTENT_TYPES = {'application/xml', 'application/xhtml', 'application/
                            'application/x-msdos-program', 'application/textedit',
                            'application/vnd.openxmlformats-officedocument.wordprocessingml.document'}
 TEXT_FILE_EXTENSIONS = {'.csv', '.txt', '.md', '.py', '.bat', '.sh', '.rb', '.js', '.asm', '.log'}
+SURROGATE_ESCAPES = re.compile('[\udc80-\udcff]')
+HEADER_CACHE_SIZE = 4096
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
+DEFAULT_HASH_ALGORITHMS = ('md5', 'sha256')
+HASH_CHUNK_SIZE = 1048576
+SKIPPED_PART_HEADER = 'X-Mailclient-Skipped-Size'
 """
 It already indexes all text/* including:
     'text/plain', 'text/html', 'text/x-asm', 'text/x-c','text/x-python-script','text/x-python'
@@ -21,24 +29,97 @@ No need to add this to the supported types list
 """
 
 
+_header_cache = {}
+
+
 def getheader(header_text, default="ascii"):
-    """ This decodes sections of the email header which could be represented in utf8 or other iso languages"""
+    """
+    This decodes sections of the email header which could be represented in utf8 or other iso languages.
+    Decoded values are cached, as the same From, To and Subject headers show up across many mails.
+    """
+    cacheable = isinstance(header_text, text_type)
+    if cacheable:
+        decoded = _header_cache.get((header_text, default))
+        if decoded is not None:
+            return decoded
     headers = decode_header(header_text)
-    header_sections = [text if isinstance(text, text_type) else text_type(text, charset or default, "ignore") for text, charset in headers]
-    return "".join(header_sections)
+    header_sections = [text if isinstance(text, text_type) else decode_header_section(text, charset or default) for text, charset in headers]
+    decoded = replace_surrogates("".join(header_sections)).replace("\r\n", "\n")
+    if cacheable:
+        if len(_header_cache) >= HEADER_CACHE_SIZE:
+            _header_cache.clear()
+        _header_cache[(header_text, default)] = decoded
+    return decoded
+
+
+def decode_header_section(text, charset):
+    """ Decodes one section of a header, falling back to utf8 for 8-bit headers (unknown-8bit) and unknown charsets"""
+    try:
+        return text_type(text, charset, "ignore")
+    except LookupError:
+        return text_type(text, "utf-8", "replace")
+
+
+def replace_surrogates(text):
+    """
+    Mails parsed from bytes keep undecodable bytes as surrogate escapes. This restores those bytes and
+    decodes them as utf8, so that 8-bit headers are readable and the output is always valid utf8.
+    """
+    if isinstance(text, text_type) and SURROGATE_ESCAPES.search(text):
+        return text.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
+    return text
+
+
+def get_decoded_payload(part):
+    """
+    This returns the payload of a mail part with its transfer encoding (base64, quoted-printable) decoded.
+    The result is kept on the part, so hashing, text recoding and archive extraction all share one buffer.
+    """
+    try:
+        return part.decoded_payload
+    except AttributeError:
+        part.decoded_payload = part.get_payload(decode=True)
+        return part.decoded_payload
 
 
 def recode_mail(part):
     cset = part.get_content_charset()
     if cset == "None":
         cset = "ascii"
+    payload = get_decoded_payload(part)
     try:
-        if not part.get_payload(decode=True):
+        if not payload:
             result = ""
         else:
-            result = text_type(part.get_payload(decode=True), cset, "ignore").encode('utf8', 'xmlcharrefreplace').strip()
+            result = text_type(payload, cset, "ignore").encode('utf8', 'xmlcharrefreplace').strip()
     except TypeError:
-        result = part.get_payload(decode=True)
+        result = payload
         if isinstance(result, text_type):
             result = result.encode('utf8', 'xmlcharrefreplace').strip()
     return result
+
+
+def get_payload_hashes(part, algorithms=DEFAULT_HASH_ALGORITHMS):
+    """
+    This computes all the requested digests of a part's decoded payload in a single pass. Each chunk is fed
+    to every digest while it is still in cache, and memoryview slices avoid copying the payload.
+    :param part: This is a MIME part from an email
+    :type part: email.message.Message
+    :param algorithms: Names of the hashlib algorithms to compute
+    :type algorithms: Union[list, tuple]
+    :return: Returns a list of (algorithm, hexdigest), which is empty if the part has no payload of its own,
+      as multipart and message/rfc822 parts
+    :rtype: list
+    """
+    if not algorithms:
+        return []
+    payload = get_decoded_payload(part)
+    if not isinstance(payload, binary_type):
+        return []
+    digests = [hashlib.new(name) for name in algorithms]
+    view = memoryview(payload)
+    for offset in range(0, len(view), HASH_CHUNK_SIZE):
+        chunk = view[offset:offset + HASH_CHUNK_SIZE]
+        for digest in digests:
+            digest.update(chunk)
+    return [(name, digest.hexdigest()) for name, digest in zip(algorithms, digests)]
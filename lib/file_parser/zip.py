@@ -20,7 +20,7 @@ def parse_zip(part, part_name):
     :rtype: list
     """
     if EMAIL_PART == part_name:
-        decoded_payload = part.get_payload(decode=True)
+        decoded_payload = get_decoded_payload(part)
         zip_name = part.get_filename() or ''
     else:
         decoded_payload = part
@@ -0,0 +1,610 @@
+from __future__ import unicode_literals
+
+"""This contains the checkpoint store used to keep track of indexed mails and mailbox sync state"""
+
+from six import text_type
+
+from mail_constants import *
+import functools
+import hashlib
+import math
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+
+BLOOM_HEADER = struct.Struct('<8sQQQQQ')
+BLOOM_MAGIC = b'TAMBLOOM'
+LEGACY_CHECKPOINT_REGEX = re.compile(r'^[0-9a-f]{64}$')
+
+
+def get_checkpoint_digest(msg):
+    """
+    This returns the digest used as the key for a message checkpoint.
+    It is the same as the name of the checkpoint files created by earlier versions.
+    :param msg: Contains the Message-ID of the mail
+    :type msg: basestring
+    :return: Returns the hex digest of the Message-ID
+    :rtype: basestring
+    """
+    return hashlib.sha256(msg.encode("utf8", "backslashreplace")).hexdigest()
+
+
+def synchronized(method):
+    """
+    This runs a CheckpointStore method while holding the store lock, as the store is shared by the
+    fetch and writer threads of the mail pipeline.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class BloomFilter(object):
+    """
+    This is a Bloom filter kept in a memory-mapped file, so that it persists between runs and is shared by
+    every input using the checkpoint directory. Bit positions are derived from checkpoint digests.
+    The header holds the number of bits, hash functions, elements added, the capacity it was sized for
+    and the highest checkpoint rowid it includes.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'r+b')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0)
+        except (ValueError, mmap.error):
+            self.file.close()
+            raise ValueError("Empty bloom filter file: %s" % filename)
+        magic, self.nbits, self.nhashes = BLOOM_HEADER.unpack_from(self.map)[:3]
+        if magic != BLOOM_MAGIC or len(self.map) != BLOOM_HEADER.size + self.nbits // 8:
+            self.close()
+            raise ValueError("Invalid bloom filter file: %s" % filename)
+
+    @staticmethod
+    def create(filename, capacity, false_positive_rate, digests=(), synced_rowid=0):
+        """
+        This writes a new filter sized for capacity elements and loaded with the given digests.
+        :return: Returns the new BloomFilter
+        :rtype: BloomFilter
+        """
+        nbits = int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2) / 8)) * 8
+        nhashes = max(1, int(round(nbits / float(capacity) * math.log(2))))
+        bits = bytearray(nbits // 8)
+        count = 0
+        for digest in digests:
+            new_bit = False
+            for position in BloomFilter.positions(digest, nbits, nhashes):
+                if not bits[position >> 3] & (1 << (position & 7)):
+                    bits[position >> 3] |= 1 << (position & 7)
+                    new_bit = True
+            count += new_bit
+        with open(filename, 'wb') as f:
+            f.write(BLOOM_HEADER.pack(BLOOM_MAGIC, nbits, nhashes, count, capacity, synced_rowid))
+            f.write(bits)
+        return BloomFilter(filename)
+
+    @staticmethod
+    def positions(digest, nbits, nhashes):
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:32], 16) | 1
+        return [(h1 + i * h2) % nbits for i in range(nhashes)]
+
+    def _header_field(self, index):
+        return BLOOM_HEADER.unpack_from(self.map)[index]
+
+    def _set_header_field(self, index, value):
+        fields = list(BLOOM_HEADER.unpack_from(self.map))
+        fields[index] = value
+        BLOOM_HEADER.pack_into(self.map, 0, *fields)
+
+    @property
+    def count(self):
+        return self._header_field(3)
+
+    @property
+    def capacity(self):
+        return self._header_field(4)
+
+    @property
+    def synced_rowid(self):
+        return self._header_field(5)
+
+    @synced_rowid.setter
+    def synced_rowid(self, rowid):
+        self._set_header_field(5, rowid)
+
+    def add(self, digest):
+        """
+        This adds a checkpoint digest to the filter.
+        """
+        new_bit = False
+        for position in self.positions(digest, self.nbits, self.nhashes):
+            offset = BLOOM_HEADER.size + (position >> 3)
+            byte = ord(self.map[offset:offset + 1])
+            if not byte & (1 << (position & 7)):
+                self.map[offset:offset + 1] = struct.pack('B', byte | (1 << (position & 7)))
+                new_bit = True
+        if new_bit:
+            self._set_header_field(3, self.count + 1)
+
+    def might_contain(self, digest):
+        """
+        :return: Returns False if the digest has definitely not been added, and True if it might have been.
+        :rtype: bool
+        """
+        for position in self.positions(digest, self.nbits, self.nhashes):
+            offset = BLOOM_HEADER.size + (position >> 3)
+            if not ord(self.map[offset:offset + 1]) & (1 << (position & 7)):
+                return False
+        return True
+
+    def false_positive_rate(self):
+        """
+        :return: Returns the expected false-positive rate for the number of elements added so far.
+        :rtype: float
+        """
+        return (1 - math.exp(-self.nhashes * self.count / float(self.nbits))) ** self.nhashes
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class CheckpointStore(object):
+    """
+    This keeps track of indexed mails, and of the sync state of every mailbox folder, in a single SQLite
+    database within the checkpoint directory. New checkpoints are buffered and written in one transaction
+    by commit(), which is also done before any sync state gets updated. It can be used from several threads.
+    """
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(os.path.join(checkpoint_dir, CHECKPOINT_DB),
+                                          timeout=CHECKPOINT_DB_TIMEOUT, isolation_level=None,
+                                          check_same_thread=False)
+        """auto_vacuum only takes effect if it is set before the first table gets created"""
+        self.connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                digest TEXT PRIMARY KEY, indexed_at REAL, mailbox TEXT, folder TEXT, uidvalidity TEXT, uid TEXT);
+            CREATE INDEX IF NOT EXISTS checkpoints_indexed_at ON checkpoints (indexed_at);
+            CREATE INDEX IF NOT EXISTS checkpoints_location ON checkpoints (mailbox, folder);
+            CREATE TABLE IF NOT EXISTS folder_cursors (
+                mailbox TEXT, folder TEXT, uidvalidity TEXT, last_uid INTEGER, uidnext INTEGER, messages INTEGER,
+                highestmodseq INTEGER, PRIMARY KEY (mailbox, folder));
+            CREATE TABLE IF NOT EXISTS pending_deletes (mailbox TEXT, folder TEXT, uidvalidity TEXT, uid TEXT);
+            CREATE INDEX IF NOT EXISTS pending_deletes_folder ON pending_deletes (mailbox, folder);
+            CREATE TABLE IF NOT EXISTS pop_uidls (mailbox TEXT, uidl TEXT, PRIMARY KEY (mailbox, uidl));
+            CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TEMP TABLE IF NOT EXISTS server_listing (mailbox TEXT, folder TEXT, uid TEXT);
+            CREATE INDEX IF NOT EXISTS temp.server_listing_uid ON server_listing (mailbox, folder, uid);
+            CREATE TEMP TABLE IF NOT EXISTS vanished (mailbox TEXT, folder TEXT, uid TEXT);
+            CREATE INDEX IF NOT EXISTS temp.vanished_uid ON vanished (mailbox, folder, uid);
+        """)
+        self.add_columns('folder_cursors', [('uidnext', 'INTEGER'), ('messages', 'INTEGER'),
+                                            ('highestmodseq', 'INTEGER')])
+        self.new_checkpoints = {}
+        """UIDVALIDITY of the folders listed or reported as vanished since the last compaction of their mailbox"""
+        self.listed_folders = {}
+        self.vanished_folders = {}
+        self.migrate_checkpoint_files()
+        self.bloom = None
+        self.open_bloom_filter()
+
+    def migrate_checkpoint_files(self):
+        """
+        This imports the empty one-file-per-message checkpoints created by earlier versions, keeping the time
+        the file was written, and removes the files once they have been committed to the database.
+        It only runs once for a checkpoint directory.
+        """
+        if self.get_metadata('legacy_files_migrated'):
+            return
+        migrated_files = []
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            if self.get_metadata('legacy_files_migrated'):
+                self.connection.execute('ROLLBACK')
+                return
+            rows = []
+            for entry in os.listdir(self.checkpoint_dir):
+                if not LEGACY_CHECKPOINT_REGEX.match(entry):
+                    continue
+                filename = os.path.join(self.checkpoint_dir, entry)
+                try:
+                    indexed_at = os.path.getmtime(filename)
+                except OSError:
+                    continue
+                rows.append([entry, indexed_at, None, None, None, None])
+                migrated_files.append(filename)
+                if len(rows) >= CHECKPOINT_MIGRATION_BATCH:
+                    self._insert_checkpoints(rows)
+                    rows = []
+            self._insert_checkpoints(rows)
+            self.connection.execute("INSERT OR REPLACE INTO metadata VALUES ('legacy_files_migrated', ?)",
+                                    (text_type(time.time()),))
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        for filename in migrated_files:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def add_columns(self, table, columns):
+        """
+        This adds the columns that tables created by earlier versions are missing.
+        :param columns: List of (name, type) of the columns the table should have
+        :type columns: list
+        """
+        existing = set(row[1] for row in self.connection.execute('PRAGMA table_info(%s)' % table))
+        for name, column_type in columns:
+            if name not in existing:
+                self.connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, column_type))
+
+    def get_bloom_filename(self, generation):
+        return os.path.join(self.checkpoint_dir, "%s.%s.bloom" % (CHECKPOINT_DB, generation))
+
+    def open_bloom_filter(self):
+        """
+        This opens the Bloom filter placed in front of checkpoint lookups, and adds the checkpoints committed
+        since it was last used. The filter is rebuilt, sized from the current number of checkpoints,
+        if it is missing or if its false-positive rate has drifted above twice the target.
+        """
+        generation = self.get_metadata('bloom_generation')
+        try:
+            self.bloom = BloomFilter(self.get_bloom_filename(generation)) if generation else None
+        except (OSError, IOError, ValueError):
+            self.bloom = None
+        if self.bloom is not None:
+            last_rowid = self.bloom.synced_rowid
+            for rowid, digest in self.connection.execute(
+                    'SELECT rowid, digest FROM checkpoints WHERE rowid > ? ORDER BY rowid', (last_rowid,)):
+                self.bloom.add(digest)
+                last_rowid = rowid
+            self.bloom.synced_rowid = last_rowid
+            if not self.bloom_filter_drifted():
+                return
+        self.rebuild_bloom_filter()
+
+    def bloom_filter_drifted(self):
+        """
+        :return: Returns whether the Bloom filter holds more checkpoints than it was sized for, whether more than
+         half of them have been removed since, or whether its false-positive rate is above twice the target
+        :rtype: bool
+        """
+        """Removed checkpoints cannot be cleared from the filter and only add to its false-positive rate"""
+        removed = int(self.get_metadata('removed_since_bloom') or 0)
+        return self.bloom.count > self.bloom.capacity or removed > self.bloom.count // 2 or \
+            self.bloom.false_positive_rate() > 2 * BLOOM_FALSE_POSITIVE_RATE
+
+    def rebuild_bloom_filter(self):
+        """
+        This writes a new generation of the Bloom filter from every checkpoint in the database.
+        Inputs still using the previous generation pick up the new one the next time they open the store.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            generation = int(self.get_metadata('bloom_generation') or 0) + 1
+            count, synced_rowid = self.connection.execute('SELECT count(*), max(rowid) FROM checkpoints').fetchone()
+            capacity = max(BLOOM_MIN_CAPACITY, int(count * BLOOM_GROWTH_FACTOR))
+            bloom = BloomFilter.create(self.get_bloom_filename(generation), capacity, BLOOM_FALSE_POSITIVE_RATE,
+                                       (row[0] for row in self.connection.execute('SELECT digest FROM checkpoints')),
+                                       synced_rowid or 0)
+            self.connection.execute("INSERT OR REPLACE INTO metadata VALUES ('bloom_generation', ?)",
+                                    (text_type(generation),))
+            self.connection.execute("INSERT OR REPLACE INTO metadata VALUES ('removed_since_bloom', '0')")
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        if self.bloom is not None:
+            self.bloom.close()
+        self.bloom = bloom
+        for entry in os.listdir(self.checkpoint_dir):
+            if entry.endswith('.bloom') and entry != os.path.basename(bloom.filename):
+                try:
+                    os.remove(os.path.join(self.checkpoint_dir, entry))
+                except OSError:
+                    pass
+
+    @synchronized
+    def get_metadata(self, key):
+        """
+        :return: Returns a value from the metadata table, or None if it has not been set.
+        """
+        row = self.connection.execute('SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _to_text(value):
+        return None if value is None else text_type(value)
+
+    def _insert_checkpoints(self, rows):
+        if rows:
+            self.connection.executemany('INSERT OR IGNORE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def _write(self, statements=()):
+        """
+        This writes the buffered checkpoints and the given (sql, parameters) statements in a single transaction.
+        """
+        if not self.new_checkpoints and not statements:
+            return
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self._insert_checkpoints(list(self.new_checkpoints.values()))
+            for sql, parameters in statements:
+                if parameters and isinstance(parameters[0], (list, tuple)):
+                    self.connection.executemany(sql, parameters)
+                else:
+                    self.connection.execute(sql, parameters)
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.new_checkpoints = {}
+
+    @synchronized
+    def commit(self):
+        """
+        This writes the buffered checkpoints to the database.
+        """
+        self._write()
+
+    @synchronized
+    def close(self):
+        """
+        This commits any buffered checkpoint and closes the database.
+        """
+        self.commit()
+        self.connection.close()
+        if self.bloom is not None:
+            self.bloom.close()
+
+    @synchronized
+    def save_checkpoint(self, msg, location=None):
+        """
+        This records that a message has been indexed. It is buffered until the next commit.
+        :param msg: Contains the Message-ID of the mail
+        :type msg: basestring
+        :param location: Where the mail was found, as [mailbox, folder, uidvalidity, uid] for IMAP
+         or [mailbox, 'POP3', None, uidl] for POP3
+        :type location: list
+        """
+        digest = get_checkpoint_digest(msg)
+        location = (list(location or []) + [None] * 4)[:4]
+        self.new_checkpoints[digest] = [digest, time.time()] + [self._to_text(l) for l in location]
+        self.bloom.add(digest)
+
+    @synchronized
+    def locate_checkpoint(self, msg):
+        """
+        This checks if a message has already been indexed.
+        :param msg: Contains the Message-ID of the mail
+        :type msg: basestring
+        :return: Returns true if the message has been indexed previously, and false if not.
+        :rtype: bool
+        """
+        digest = get_checkpoint_digest(msg)
+        if digest in self.new_checkpoints:
+            return True
+        if not self.bloom.might_contain(digest):
+            return False
+        return self.connection.execute('SELECT 1 FROM checkpoints WHERE digest = ?', (digest,)).fetchone() is not None
+
+    @synchronized
+    def load_folder_cursor(self, mailbox, folder):
+        """
+        This reads the sync cursor saved for an IMAP folder at the end of the previous run.
+        :return: Returns (uidvalidity, last_uid), or (None, 0) if the folder has never been synced
+        :rtype: tuple
+        """
+        row = self.connection.execute(
+            'SELECT uidvalidity, last_uid FROM folder_cursors WHERE mailbox = ? AND folder = ?',
+            (mailbox, folder)).fetchone()
+        return (row[0], int(row[1])) if row else (None, 0)
+
+    @synchronized
+    def save_folder_cursor(self, mailbox, folder, uidvalidity, last_uid, uidnext=None, messages=None,
+                           highestmodseq=None):
+        """
+        This saves the UIDVALIDITY and the highest UID processed for an IMAP folder,
+        after committing the checkpoints of the mails below that UID. The UIDNEXT, MESSAGES and HIGHESTMODSEQ
+        reported by STATUS are only saved once the folder has been fully synced.
+        """
+        self._write([('INSERT OR REPLACE INTO folder_cursors (mailbox, folder, uidvalidity, last_uid, uidnext, '
+                      'messages, highestmodseq) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (mailbox, folder, self._to_text(uidvalidity), last_uid, uidnext, messages, highestmodseq))])
+
+    @synchronized
+    def load_folder_status(self, mailbox, folder):
+        """
+        This reads the STATUS of an IMAP folder saved at the end of its last full sync.
+        :return: Returns (uidvalidity, uidnext, messages, highestmodseq), with None values if the folder has not
+         been fully synced
+        :rtype: tuple
+        """
+        row = self.connection.execute(
+            'SELECT uidvalidity, uidnext, messages, highestmodseq FROM folder_cursors WHERE mailbox = ? AND folder = ?',
+            (mailbox, folder)).fetchone()
+        return tuple(row) if row else (None, None, None, None)
+
+    @synchronized
+    def load_pending_deletes(self, mailbox, folder):
+        """
+        This reads the mails that were indexed in the previous run and are waiting to be deleted (delayed cleanup).
+        :return: Returns (uidvalidity, ids) where ids are IMAP UIDs or POP3 UIDLs, or (None, []) if there are none
+        :rtype: tuple
+        """
+        rows = self.connection.execute(
+            'SELECT uidvalidity, uid FROM pending_deletes WHERE mailbox = ? AND folder = ?',
+            (mailbox, folder)).fetchall()
+        if not rows:
+            return None, []
+        return rows[0][0], [row[1] for row in rows]
+
+    @synchronized
+    def save_pending_deletes(self, mailbox, folder, uidvalidity, ids):
+        """
+        This replaces the list of mails to be deleted by the next run of a folder.
+        """
+        statements = [('DELETE FROM pending_deletes WHERE mailbox = ? AND folder = ?', (mailbox, folder))]
+        if ids:
+            statements.append(('INSERT INTO pending_deletes VALUES (?, ?, ?, ?)',
+                               [(mailbox, folder, self._to_text(uidvalidity), text_type(i)) for i in ids]))
+        self._write(statements)
+
+    @synchronized
+    def load_pop_uidls(self, mailbox):
+        """
+        :return: Returns the set of UIDLs of the POP3 mails that are known to be indexed.
+        :rtype: set
+        """
+        return set(row[0] for row in self.connection.execute('SELECT uidl FROM pop_uidls WHERE mailbox = ?',
+                                                             (mailbox,)))
+
+    @synchronized
+    def save_pop_uidls(self, mailbox, uidls):
+        """
+        This replaces the UIDLs of the indexed POP3 mails that are still on the server.
+        """
+        statements = [('DELETE FROM pop_uidls WHERE mailbox = ?', (mailbox,))]
+        if uidls:
+            statements.append(('INSERT OR IGNORE INTO pop_uidls VALUES (?, ?)', [(mailbox, u) for u in uidls]))
+        self._write(statements)
+
+    @synchronized
+    def record_server_listing(self, mailbox, folder, uidvalidity, ids):
+        """
+        This keeps the full list of mails found on the server for a folder during this run, so that
+        compact() can remove the checkpoints of mails that are no longer there. It replaces any listing
+        recorded for the folder since the last compaction.
+        :param mailbox: The mailbox (input stanza)
+        :type mailbox: basestring
+        :param folder: The IMAP folder name, or POP3
+        :type folder: basestring
+        :param uidvalidity: UIDVALIDITY of the folder, or None for POP3
+        :type uidvalidity: basestring
+        :param ids: Every IMAP UID or POP3 UIDL currently in the folder
+        :type ids: list
+        """
+        self.connection.execute('DELETE FROM server_listing WHERE mailbox = ? AND folder = ?', (mailbox, folder))
+        self.connection.executemany('INSERT INTO server_listing VALUES (?, ?, ?)',
+                                    [(mailbox, folder, text_type(i)) for i in ids])
+        self.listed_folders[(mailbox, folder)] = self._to_text(uidvalidity)
+
+    @synchronized
+    def record_vanished(self, mailbox, folder, uidvalidity, ids):
+        """
+        This keeps the mails reported as expunged from a folder since its last full sync, so that compact()
+        can remove their checkpoints without the full list of mails in the folder. Mails reported earlier with
+        the same UIDVALIDITY are kept, while a listing recorded for the folder no longer holds the mails
+        indexed since, and is dropped.
+        :param mailbox: The mailbox (input stanza)
+        :type mailbox: basestring
+        :param folder: The IMAP folder name
+        :type folder: basestring
+        :param uidvalidity: UIDVALIDITY of the folder
+        :type uidvalidity: basestring
+        :param ids: IMAP UIDs reported by VANISHED
+        :type ids: list
+        """
+        uidvalidity = self._to_text(uidvalidity)
+        if self.vanished_folders.get((mailbox, folder)) != uidvalidity:
+            self.connection.execute('DELETE FROM vanished WHERE mailbox = ? AND folder = ?', (mailbox, folder))
+        self.connection.executemany('INSERT INTO vanished VALUES (?, ?, ?)',
+                                    [(mailbox, folder, text_type(i)) for i in ids])
+        self.vanished_folders[(mailbox, folder)] = uidvalidity
+        if self.listed_folders.pop((mailbox, folder), None) is not None:
+            self.connection.execute('DELETE FROM server_listing WHERE mailbox = ? AND folder = ?', (mailbox, folder))
+
+    def _remove_checkpoints(self, condition, parameters):
+        """
+        This removes up to CHECKPOINT_COMPACTION_BATCH checkpoints matching the condition in one transaction.
+        The newest checkpoint is always kept so that rowids are never reused, as the Bloom filter relies on them.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = self.connection.execute(
+                'DELETE FROM checkpoints WHERE rowid IN (SELECT rowid FROM checkpoints WHERE (%s) '
+                'AND rowid < (SELECT max(rowid) FROM checkpoints) LIMIT ?)' % condition,
+                tuple(parameters) + (CHECKPOINT_COMPACTION_BATCH,))
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        return cursor.rowcount
+
+    def _forget_listings(self, mailbox):
+        """
+        This drops the server listings and vanished mails recorded for the folders of a mailbox.
+        """
+        for folders in (self.listed_folders, self.vanished_folders):
+            for key in [key for key in folders if key[0] == mailbox]:
+                del folders[key]
+        self.connection.execute('DELETE FROM server_listing WHERE mailbox = ?', (mailbox,))
+        self.connection.execute('DELETE FROM vanished WHERE mailbox = ?', (mailbox,))
+
+    @synchronized
+    def compact(self, mailbox, retention_days, time_budget):
+        """
+        This applies the retention policy of an input to the checkpoints. Checkpoints older than retention_days
+        are removed, along with those of mails missing from the server listings recorded during this run,
+        or reported as vanished. The listings and vanished mails of the mailbox are then forgotten.
+        Checkpoints imported from earlier versions have no mailbox and are only removed by age.
+        Removal runs in small transactions and stops once time_budget is spent; the rest is left for the next run.
+        The Bloom filter is then rebuilt if it has drifted, as the store stays open between runs.
+        :param mailbox: The mailbox (input stanza)
+        :type mailbox: basestring
+        :param retention_days: Maximum age of checkpoints in days, or 0 to keep them regardless of age
+        :type retention_days: int
+        :param time_budget: Number of seconds the compaction may run for
+        :type time_budget: float
+        :return: Returns the number of checkpoints removed
+        :rtype: int
+        """
+        self.commit()
+        deadline = time.time() + time_budget
+        conditions = []
+        if retention_days:
+            conditions.append(('(mailbox = ? OR mailbox IS NULL) AND indexed_at < ?',
+                               (mailbox, time.time() - retention_days * 86400)))
+        for (listed_mailbox, folder), uidvalidity in sorted(self.listed_folders.items(), key=text_type):
+            if listed_mailbox == mailbox:
+                conditions.append((
+                    'mailbox = ? AND folder = ? AND (uidvalidity IS NOT ? OR uid NOT IN '
+                    '(SELECT uid FROM server_listing WHERE mailbox = ? AND folder = ?))',
+                    (mailbox, folder, uidvalidity, mailbox, folder)))
+        for (vanished_mailbox, folder), uidvalidity in sorted(self.vanished_folders.items(), key=text_type):
+            if vanished_mailbox == mailbox:
+                conditions.append((
+                    'mailbox = ? AND folder = ? AND (uidvalidity IS NOT ? OR uid IN '
+                    '(SELECT uid FROM vanished WHERE mailbox = ? AND folder = ?))',
+                    (mailbox, folder, uidvalidity, mailbox, folder)))
+        removed = 0
+        for condition, parameters in conditions:
+            while time.time() < deadline:
+                chunk_removed = self._remove_checkpoints(condition, parameters)
+                removed += chunk_removed
+                if chunk_removed < CHECKPOINT_COMPACTION_BATCH:
+                    break
+        """These only hold for the run that recorded them, while the store stays open between runs"""
+        self._forget_listings(mailbox)
+        if removed:
+            self._write([("INSERT OR REPLACE INTO metadata VALUES ('removed_since_bloom', ?)",
+                          (text_type(int(self.get_metadata('removed_since_bloom') or 0) + removed),))])
+        if self.bloom_filter_drifted():
+            self.rebuild_bloom_filter()
+        if time.time() < deadline:
+            self.connection.execute('PRAGMA incremental_vacuum(%d)' % CHECKPOINT_VACUUM_PAGES)
+        return removed
@@ -0,0 +1,305 @@
+from __future__ import unicode_literals
+
+"""This contains the connection manager opening the connections of the inputs to their mail servers"""
+
+from mail_constants import *
+from mail_utils import get_mail_port
+import imaplib
+import poplib
+import socket
+import ssl
+import threading
+import time
+import zlib
+
+
+class ConnectionStats(object):
+    """
+    This keeps the handshake statistics of the connections of a (server, protocol, user).
+    """
+
+    def __init__(self):
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_time = 0.0
+        self.reused = 0
+
+    def summary(self):
+        return "%d handshakes (%d resumed) in %.3fs, %d reused sessions" % (
+            self.handshakes, self.resumed, self.handshake_time, self.reused)
+
+
+class CompressionStats(object):
+    """
+    This counts the bytes read and written by a connection with COMPRESS=DEFLATE, before and after compression.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.inflated = 0
+        self.sent = 0
+        self.deflated = 0
+
+    def summary(self):
+        return "received %d bytes for %d (%.0f%%), sent %d bytes for %d (%.0f%%)" % (
+            self.received, self.inflated, 100.0 * self.received / max(self.inflated, 1),
+            self.deflated, self.sent, 100.0 * self.deflated / max(self.sent, 1))
+
+
+class TimedSSLConnection(object):
+    """
+    This opens the TLS socket of IMAP4_SSL and POP3_SSL with connect and read timeouts, resuming the given
+    ssl.SSLSession when there is one, and times the TCP and TLS handshakes.
+    """
+
+    def _open_ssl_socket(self, host, port):
+        started = time.time()
+        sock = socket.create_connection((host, port), self.connect_timeout)
+        try:
+            sock = self.ssl_context.wrap_socket(sock, server_hostname=host, session=self.ssl_session)
+        except Exception:
+            sock.close()
+            raise
+        self.handshake_time = time.time() - started
+        sock.settimeout(self.read_timeout)
+        return sock
+
+
+class IMAP4SSLConnection(TimedSSLConnection, imaplib.IMAP4_SSL):
+    """Set once QRESYNC has been enabled on the connection, which lasts as long as the connection is kept"""
+    qresync = False
+    """CompressionStats of the connection, once COMPRESS=DEFLATE is active"""
+    compression = None
+
+    def __init__(self, host, port, ssl_context, ssl_session, connect_timeout, read_timeout):
+        self.ssl_session = ssl_session
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        imaplib.IMAP4_SSL.__init__(self, host, port, ssl_context=ssl_context)
+
+    def _create_socket(self, timeout=None):
+        return self._open_ssl_socket(self.host, self.port)
+
+    def compress(self):
+        """
+        This starts COMPRESS=DEFLATE (RFC 4978). Everything read from and written to the socket afterwards goes
+        through a raw deflate stream, flushed after every write so that each command reaches the server whole.
+        imaplib has no COMPRESS command, so it is sent on the connection itself.
+        :return: Returns whether compression is active
+        :rtype: bool
+        """
+        tag = self._new_tag()
+        self.send(tag + b' COMPRESS DEFLATE\r\n')
+        while True:
+            line = self.readline()
+            if not line:
+                raise self.abort("Connection closed starting COMPRESS")
+            if line.startswith(tag + b' '):
+                break
+        del self.tagged_commands[tag]
+        if not line[len(tag):].strip().upper().startswith(b'OK'):
+            return False
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.inflated = bytearray()
+        self.compression = CompressionStats()
+        return True
+
+    def _inflate(self):
+        """
+        This reads from the socket into the buffer of inflated data.
+        :return: Returns False once the server has closed the connection
+        :rtype: bool
+        """
+        data = self.sock.recv(COMPRESS_READ_SIZE)
+        if not data:
+            return False
+        inflated = self.inflater.decompress(data)
+        self.compression.received += len(data)
+        self.compression.inflated += len(inflated)
+        self.inflated += inflated
+        return True
+
+    def read(self, size):
+        if self.compression is None:
+            return imaplib.IMAP4_SSL.read(self, size)
+        while len(self.inflated) < size and self._inflate():
+            pass
+        data = bytes(self.inflated[:size])
+        del self.inflated[:size]
+        return data
+
+    def readline(self):
+        if self.compression is None:
+            return imaplib.IMAP4_SSL.readline(self)
+        start = 0
+        end = self.inflated.find(b'\n')
+        while end < 0:
+            if len(self.inflated) > imaplib._MAXLINE:
+                raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+            start = len(self.inflated)
+            if not self._inflate():
+                end = len(self.inflated) - 1
+                break
+            end = self.inflated.find(b'\n', start)
+        line = bytes(self.inflated[:end + 1])
+        del self.inflated[:end + 1]
+        return line
+
+    def send(self, data):
+        if self.compression is None:
+            return imaplib.IMAP4_SSL.send(self, data)
+        deflated = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        self.compression.sent += len(data)
+        self.compression.deflated += len(deflated)
+        self.sock.sendall(deflated)
+
+
+class POP3SSLConnection(TimedSSLConnection, poplib.POP3_SSL):
+
+    def __init__(self, host, port, ssl_context, ssl_session, connect_timeout, read_timeout):
+        self.ssl_context = ssl_context
+        self.ssl_session = ssl_session
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        poplib.POP3_SSL.__init__(self, host, port, timeout=connect_timeout, context=ssl_context)
+
+    def _create_socket(self, timeout=None):
+        return self._open_ssl_socket(self.host, self.port)
+
+
+class ConnectionManager(object):
+    """
+    This opens the connections of the inputs, keyed by (server, protocol, user). The TLS session of the last
+    connection to a server is resumed by the next one, which skips the full handshake. When keep_alive is set,
+    as for the single instance running all inputs, authenticated IMAP connections are kept after a run and used
+    again by the next run of the same user. POP3 connections are never kept, as a POP3 session only sees
+    the mails that were in the mailbox when it started, and deletes mails when it ends.
+    """
+
+    def __init__(self, keep_alive=False, max_idle=CONNECTION_MAX_IDLE):
+        """
+        :param keep_alive: Whether authenticated IMAP connections are kept between runs
+        :type keep_alive: bool
+        :param max_idle: Number of seconds after which a kept connection is logged out instead of used again
+        :type max_idle: int
+        """
+        self.keep_alive = keep_alive
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.contexts = {}
+        self.sessions = {}
+        self.idle = {}
+        self.stats = {}
+
+    def get_stats(self, server, protocol, user):
+        """
+        :return: Returns the handshake statistics of a (server, protocol, user)
+        :rtype: ConnectionStats
+        """
+        with self.lock:
+            return self.stats.setdefault((server, protocol, user), ConnectionStats())
+
+    def acquire(self, server, protocol, user):
+        """
+        :return: Returns the authenticated connection kept for a (server, protocol, user) if it still answers
+         NOOP, or None if a new one needs to be opened
+        :rtype: imaplib.IMAP4
+        """
+        with self.lock:
+            mailclient, released = self.idle.pop((server, protocol, user), (None, 0))
+        if mailclient is None:
+            return None
+        if time.time() - released < self.max_idle:
+            try:
+                if mailclient.noop()[0] == 'OK':
+                    self.get_stats(server, protocol, user).reused += 1
+                    return mailclient
+            except Exception:
+                pass
+        self.discard(mailclient)
+        return None
+
+    def release(self, server, protocol, user, mailclient):
+        """
+        This keeps an authenticated imaplib connection for the next run of the same user if keep_alive is set,
+        and logs it out otherwise. The folder should be closed first.
+        """
+        self.save_session(server, protocol, mailclient)
+        if not self.keep_alive:
+            self.discard(mailclient)
+            return
+        with self.lock:
+            previous, _ = self.idle.get((server, protocol, user), (None, 0))
+            self.idle[(server, protocol, user)] = (mailclient, time.time())
+        if previous is not None:
+            self.discard(previous)
+
+    @staticmethod
+    def discard(mailclient):
+        """
+        This logs out of a connection, ignoring the errors of a connection that already failed.
+        """
+        try:
+            if isinstance(mailclient, poplib.POP3):
+                mailclient.close()
+            else:
+                mailclient.logout()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        This logs out of every kept connection.
+        """
+        with self.lock:
+            connections = [mailclient for mailclient, _ in self.idle.values()]
+            self.idle = {}
+        for mailclient in connections:
+            self.discard(mailclient)
+
+    def save_session(self, server, protocol, mailclient):
+        """
+        This keeps the TLS session of a connection, to be resumed by the next connection to the server.
+        With TLS 1.3 the session ticket only arrives after the handshake, so this is done once the connection
+        has been used.
+        """
+        sock = getattr(mailclient, 'sock', None)
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            with self.lock:
+                self.sessions[(server, protocol)] = session
+
+    def connect(self, server, protocol, user, connect_timeout, read_timeout):
+        """
+        This opens a new connection, resuming the last TLS session of the server when possible.
+        :param server: Mail server
+        :type server: basestring
+        :param protocol: POP3 or IMAP
+        :type protocol: basestring
+        :param user: User the connection is opened for
+        :type user: basestring
+        :param connect_timeout: Seconds to wait for the connection and TLS handshake
+        :type connect_timeout: int
+        :param read_timeout: Seconds to wait for each response of the server
+        :type read_timeout: int
+        :return: Returns an unauthenticated connection
+        :rtype: Union[imaplib.IMAP4_SSL, poplib.POP3_SSL]
+        """
+        port = get_mail_port(protocol)
+        with self.lock:
+            """Sessions can only be resumed with the context that created them"""
+            ssl_context = self.contexts.get((server, protocol))
+            if ssl_context is None:
+                """The same context as imaplib.IMAP4_SSL and poplib.POP3_SSL create by default"""
+                ssl_context = self.contexts[(server, protocol)] = ssl._create_stdlib_context()
+            ssl_session = self.sessions.get((server, protocol))
+        stats = self.get_stats(server, protocol, user)
+        connection_class = IMAP4SSLConnection if protocol == 'IMAP' else POP3SSLConnection
+        mailclient = connection_class(server, port, ssl_context, ssl_session, connect_timeout, read_timeout)
+        with self.lock:
+            stats.handshakes += 1
+            if mailclient.sock.session_reused:
+                stats.resumed += 1
+            stats.handshake_time += mailclient.handshake_time
+        return mailclient
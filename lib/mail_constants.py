@@ -9,11 +9,47 @@ DEFAULT_MAINTAIN_RFC = False
 DEFAULT_ATTACH_MESSAGE_PRIMARY = False
 DEFAULT_MAILBOX_CLEANUP = 'readonly'
 DEFAULT_DROP_ATTACHMENT = False
+DEFAULT_CHECKPOINT_RETENTION_DAYS = 0
+DEFAULT_CHECKPOINT_PRUNE_MISSING = False
+DEFAULT_ATTACHMENT_HASHES = 'md5,sha256'
+DEFAULT_PARSE_PROCESSES = 0
+DEFAULT_INPUT_INTERVAL = 60
+DEFAULT_IMAP_IDLE = False
+DEFAULT_CONNECT_TIMEOUT = 30
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_SPOOL_THRESHOLD_MB = 10
+DEFAULT_MAX_EVENT_SIZE = 200000
+SINGLE_INSTANCE_MODE = True
+MAX_CONCURRENT_INPUTS = 4
 MAX_FETCH_COUNT = 25
+MAX_FETCH_BYTES = 16 * 1024 * 1024
+MAX_EXPUNGE_COUNT = 500
+CONNECTION_MAX_IDLE = 25 * 60
+COMPRESS_READ_SIZE = 65536
+IMAP_IDLE_REFRESH = 28 * 60
+IMAP_STATUS_ITEMS = 'UIDNEXT UIDVALIDITY MESSAGES'
+IMAP_RECONNECT_BACKOFF_MIN = 5
+IMAP_RECONNECT_BACKOFF_MAX = 300
+PIPELINE_PARSE_THREADS = 2
+PIPELINE_MAX_MAILS = 50
+PIPELINE_MAX_BYTES = 64 * 1024 * 1024
+SPOOL_CHUNK_SIZE = 4 * 1024 * 1024
+EVENT_FETCH_RATIO = 4
+PARSE_PROCESS_MAX_TASKS = 1000
+CHECKPOINT_DB = 'mail_checkpoint.db'
+CHECKPOINT_DB_TIMEOUT = 60
+CHECKPOINT_MIGRATION_BATCH = 10000
+CHECKPOINT_COMPACTION_BATCH = 1000
+CHECKPOINT_COMPACTION_BUDGET = 5
+CHECKPOINT_VACUUM_PAGES = 1000
+BLOOM_FALSE_POSITIVE_RATE = 0.001
+BLOOM_MIN_CAPACITY = 100000
+BLOOM_GROWTH_FACTOR = 2
 REALM = 'mail'
 PASSWORD_PLACEHOLDER = 'encrypted'
 REGEX_EMAIL = r'^[_a-z0-9-]+(\.[_a-z0-9-]+)*@[a-z0-9-]+(\.[a-z0-9-]+)*(\.[a-z]{2,4})$'
 REGEX_PASSWORD = r'^([\w!@#$%-]+)$'
+REGEX_ATTACHMENT_HASHES = r'^none$|^(md5|sha1|sha224|sha256|sha384|sha512)(,(md5|sha1|sha224|sha256|sha384|sha512))*$'
 REGEX_HOSTNAME = r'^((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)(\.(25[0-5]|2[0-4][0-9]|' \
                  r'[01]?[0-9][0-9]?)){3})$|^((([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])' \
                  r'\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9]))$'
@@ -0,0 +1,252 @@
+from __future__ import unicode_literals
+
+"""This contains the pipeline that overlaps fetching, parsing and writing of mails"""
+
+from six.moves import queue
+
+from mail_constants import *
+from mail_utils import drop_attachment_from_event, truncate_event, get_mail_size
+from file_parser import email_mime
+import multiprocessing
+import threading
+import time
+
+PIPELINE_MAIL = 'mail'
+PIPELINE_CALL = 'call'
+
+
+def parse_mail(raw_email, include_headers, maintain_rfc, attach_message_primary, attachment_hashes, drop_attachment,
+               partial=False, max_event_size=0, mail_size=None, truncated=False):
+    """
+    This is the parse stage of the mail pipeline. It is a module function so that it can also be run
+    by the processes of a multiprocessing pool, which only receive its arguments and return its result.
+    :param raw_email: The mail as fetched, either as bytes (IMAP), as a list of lines (POP3) or spooled to a file
+    :type raw_email: Union[bytes, list, file]
+    :param partial: Whether the mail was rebuilt from its text parts, with its attachments left on the server
+    :type partial: bool
+    :param max_event_size: Size in bytes the event is cut to, with a #TRUNCATED marker. 0 keeps whole events.
+    :type max_event_size: int
+    :param mail_size: Size of the mail on the server, when it is known
+    :type mail_size: int
+    :param truncated: Whether only the start of the mail was fetched
+    :type truncated: bool
+    :return: Returns a list with the [date, Message-id, mail_message]
+    :rtype: list
+    """
+    """Attachments only count towards the event size once drop_attachment has removed them"""
+    extract_size = 0 if drop_attachment else max_event_size
+    message_time, message_mid, msg = email_mime.parse_email(
+        raw_email,
+        include_headers,
+        maintain_rfc,
+        attach_message_primary,
+        attachment_hashes,
+        partial,
+        extract_size,
+    )
+    if msg is not None and drop_attachment:
+        msg = drop_attachment_from_event(msg)
+    if msg is not None and max_event_size:
+        msg = truncate_event(msg, max_event_size, mail_size or get_mail_size(raw_email), truncated)
+    return [message_time, message_mid, msg]
+
+
+def create_parse_pool(processes):
+    """
+    This starts the process pool parsing mails when parse_processes is set. The pool replaces each worker after
+    PARSE_PROCESS_MAX_TASKS mails from a thread of its own, while the inputs are running in other threads.
+    Forking a process with running threads can leave the child with locks held by threads it does not have,
+    so workers are started from a fork server, which has no other thread, or spawned where there is none.
+    :param processes: Number of worker processes
+    :type processes: int
+    :rtype: multiprocessing.pool.Pool
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['mail_pipeline'])
+    else:
+        context = multiprocessing.get_context('spawn')
+    return context.Pool(processes, maxtasksperchild=PARSE_PROCESS_MAX_TASKS)
+
+
+class PipelineStage(object):
+    """
+    This keeps the queue depth and wait time statistics of a pipeline stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.wait_time = 0.0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.samples = 0
+
+    def record_wait(self, started):
+        with self.lock:
+            self.wait_time += time.time() - started
+
+    def record_depth(self, depth):
+        with self.lock:
+            self.depth_total += depth
+            self.depth_max = max(self.depth_max, depth)
+            self.samples += 1
+
+    def summary(self):
+        average = float(self.depth_total) / self.samples if self.samples else 0.0
+        return "%s: waited %.3fs, queue depth avg %.1f max %d" % (self.name, self.wait_time, average, self.depth_max)
+
+
+class MailPipeline(object):
+    """
+    This runs the parsing and writing of fetched mails in their own threads, so that the connection to the mail
+    server keeps fetching while earlier mails are parsed and written. Only the calling (fetch) thread talks to the
+    mail server. Parse workers may finish out of order, but a single writer thread writes the mails in the order
+    they were fetched. The number and total size of the mails in flight are bounded, so fetching blocks whenever
+    parsing or writing falls behind.
+    """
+
+    def __init__(self, parse, write, workers=PIPELINE_PARSE_THREADS, max_mails=PIPELINE_MAX_MAILS,
+                 max_bytes=PIPELINE_MAX_BYTES):
+        """
+        :param parse: Called by a parse worker with a fetched mail. Its result is passed on to write.
+        :type parse: function
+        :param write: Called by the writer thread with a fetched mail and the result of parse
+        :type write: function
+        :param workers: Number of parse worker threads
+        :type workers: int
+        :param max_mails: Maximum number of mails in flight
+        :type max_mails: int
+        :param max_bytes: Maximum total size of the mails in flight. A single larger mail is still accepted.
+        :type max_bytes: int
+        """
+        self.parse = parse
+        self.write = write
+        self.max_mails = max_mails
+        self.max_bytes = max_bytes
+        self.parse_queue = queue.Queue(max_mails)
+        self.write_queue = queue.Queue(max_mails)
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+        self.next_sequence = 0
+        self.error = None
+        self.fetch_stage = PipelineStage('fetch')
+        self.parse_stage = PipelineStage('parse')
+        self.write_stage = PipelineStage('write')
+        self.workers = [threading.Thread(target=self._parse_worker, name='mail-parse-%d' % i)
+                        for i in range(max(1, workers))]
+        self.writer = threading.Thread(target=self._writer, name='mail-write')
+        for thread in self.workers + [self.writer]:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, mail, size=0):
+        """
+        This queues a fetched mail to be parsed and written. It blocks while the pipeline is full.
+        :param mail: The fetched mail, as expected by the parse and write functions
+        :param size: Size of the mail in bytes, used to bound the memory held by the pipeline
+        :type size: int
+        """
+        self._submit(PIPELINE_MAIL, mail, size)
+
+    def call(self, function):
+        """
+        This runs a function in the writer thread once every mail queued before it has been written.
+        It is used to commit checkpoints and save sync state in step with the written events.
+        :param function: Function called without arguments
+        :type function: function
+        """
+        self._submit(PIPELINE_CALL, function, 0)
+
+    def join(self):
+        """
+        This waits until every queued mail has been written, and raises the first error of the parse or write stage.
+        """
+        with self.condition:
+            while self.in_flight and self.error is None:
+                self.condition.wait()
+            self._raise_error()
+
+    def close(self):
+        """
+        This lets the queued mails be written and stops the pipeline threads.
+        """
+        for _ in self.workers:
+            self.parse_queue.put(None)
+        for thread in self.workers:
+            thread.join()
+        self.write_queue.put(None)
+        self.writer.join()
+
+    def summary(self):
+        """
+        :return: Returns the wait time and queue depth statistics of every stage
+        :rtype: basestring
+        """
+        return "; ".join(stage.summary() for stage in (self.fetch_stage, self.parse_stage, self.write_stage))
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _submit(self, kind, payload, size):
+        started = time.time()
+        with self.condition:
+            while self.error is None and self.in_flight and (
+                    self.in_flight >= self.max_mails or self.in_flight_bytes + size > self.max_bytes):
+                self.condition.wait()
+            self._raise_error()
+            self.in_flight += 1
+            self.in_flight_bytes += size
+            sequence = self.next_sequence
+            self.next_sequence += 1
+        self.fetch_stage.record_wait(started)
+        self.parse_stage.record_depth(self.parse_queue.qsize())
+        self.parse_queue.put((sequence, kind, payload, size))
+
+    def _parse_worker(self):
+        while True:
+            started = time.time()
+            item = self.parse_queue.get()
+            self.parse_stage.record_wait(started)
+            if item is None:
+                return
+            sequence, kind, payload, size = item
+            result = error = None
+            if kind == PIPELINE_MAIL and self.error is None:
+                try:
+                    result = self.parse(payload)
+                except Exception as e:
+                    error = e
+            self.write_stage.record_depth(self.write_queue.qsize())
+            self.write_queue.put((sequence, kind, payload, size, result, error))
+
+    def _writer(self):
+        """Results are written in sequence order, so they are held here until all earlier ones have arrived"""
+        pending = {}
+        sequence = 0
+        while True:
+            started = time.time()
+            item = self.write_queue.get()
+            self.write_stage.record_wait(started)
+            if item is None:
+                return
+            pending[item[0]] = item
+            while sequence in pending:
+                _, kind, payload, size, result, error = pending.pop(sequence)
+                sequence += 1
+                if error is None and self.error is None:
+                    try:
+                        if kind == PIPELINE_CALL:
+                            payload()
+                        else:
+                            self.write(payload, result)
+                    except Exception as e:
+                        error = e
+                with self.condition:
+                    if error is not None and self.error is None:
+                        self.error = error
+                    self.in_flight -= 1
+                    self.in_flight_bytes -= size
+                    self.condition.notify_all()
@@ -0,0 +1,83 @@
+from __future__ import unicode_literals
+
+"""This contains the scheduler running every input of the single instance modular input"""
+
+from mail_constants import *
+import heapq
+import itertools
+import threading
+import time
+
+
+class InputScheduler(object):
+    """
+    This runs every input at its own interval within a single process, with at most max_concurrency inputs
+    running at the same time. Runs of the same input never overlap: the next run is due one interval after
+    the previous one started, or straight away if it took longer than the interval.
+    """
+
+    def __init__(self, log, max_concurrency=MAX_CONCURRENT_INPUTS):
+        """
+        :param log: Function used for logging, taking a severity and a message
+        :type log: function
+        :param max_concurrency: Maximum number of inputs running at once
+        :type max_concurrency: int
+        """
+        self.log = log
+        self.slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self.condition = threading.Condition()
+        self.schedule = []
+        self.sequence = itertools.count()
+        self.stopped = False
+
+    def add(self, name, interval, function):
+        """
+        This adds an input, which first runs as soon as a slot is free.
+        :param name: Name of the input, used for logging
+        :type name: basestring
+        :param interval: Number of seconds between the start of two runs
+        :type interval: int
+        :param function: Function called without arguments for every run
+        :type function: function
+        """
+        with self.condition:
+            heapq.heappush(self.schedule, (time.time(), next(self.sequence), name, interval, function))
+            self.condition.notify()
+
+    def stop(self):
+        """
+        This stops scheduling new runs. Runs in progress are left to finish.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def run(self):
+        """
+        This runs the inputs until stop() is called.
+        """
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.schedule or self.schedule[0][0] > time.time()):
+                    self.condition.wait(self.schedule[0][0] - time.time() if self.schedule else None)
+                if self.stopped:
+                    return
+                entry = heapq.heappop(self.schedule)
+            self.slots.acquire()
+            delay = time.time() - entry[0]
+            if delay > entry[3]:
+                self.log('WARN', "Input %s started %.0fs late, consider raising its interval" % (entry[2], delay))
+            thread = threading.Thread(target=self._run, args=(entry,), name='mail-input-%s' % entry[2])
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, entry):
+        due, _, name, interval, function = entry
+        started = time.time()
+        try:
+            function()
+        finally:
+            self.slots.release()
+            with self.condition:
+                heapq.heappush(self.schedule, (started + interval, next(self.sequence), name, interval, function))
+                self.condition.notify()
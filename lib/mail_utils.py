@@ -1,11 +1,12 @@
 from __future__ import unicode_literals
 
-from six import text_type, binary_type
+from six import text_type, binary_type, ensure_str
+from file_parser.utils import SUPPORTED_CONTENT_TYPES, SKIPPED_PART_HEADER
 
-import hashlib
-import os
+import imaplib
 import socket
 import re
+import time
 
 
 def mail_connectivity_test(server, protocol):
@@ -27,38 +28,6 @@ def mail_connectivity_test(server, protocol):
         raise socket.error("Socket error : %s" % e)
 
 
-def save_checkpoint(checkpoint_dir, msg):
-    """
-    This creates a checkpoint file in the checkpoint directory for the message.
-    :param checkpoint_dir: This contains the path where checkpoint files will be saved
-    :type checkpoint_dir: basestring
-    :param msg: Contains a message that needs to indexed and
-     :type msg: basestring
-    """
-    filename = os.path.join(checkpoint_dir, hashlib.sha256(msg.encode("utf8", "backslashreplace")).hexdigest())
-    f = open(filename, 'w')
-    f.close()
-
-
-def locate_checkpoint(checkpoint_dir, msg):
-    """
-    This checks if a message has already been indexed by using a digest of the first 300 characters,
-    which includes a date, message id, source and destination email addresses.
-    :param checkpoint_dir: This contains the path where checkpoint files will be saved
-    :type checkpoint_dir: basestring
-    :param msg: Contains a message that needs to indexed and
-     :type msg: basestring
-    :return: Returns true if the message has been indexed previously, and false if not.
-     :rtype: bool
-    """
-    filename = os.path.join(checkpoint_dir, hashlib.sha256(msg.encode("utf8", "backslashreplace")).hexdigest())
-    try:
-        open(filename, 'r').close()
-    except (OSError, IOError):
-        return False
-    return True
-
-
 def bool_variable(x):
     """
 
@@ -80,6 +49,514 @@ def bool_variable(x):
     return x
 
 
+def update_imap_capabilities(mailclient, login_data):
+    """
+    This reads the capabilities of an IMAP connection again after LOGIN. Servers often announce extensions such as
+    COMPRESS, CONDSTORE, QRESYNC or LIST-STATUS only once logged in, in a CAPABILITY response code of the LOGIN
+    response or in an untagged CAPABILITY response. CAPABILITY is sent again when the server sent neither.
+    :param mailclient: IMAP connection, just logged in
+    :type mailclient: imaplib.IMAP4
+    :param login_data: The data list returned by IMAP4.login
+    :type login_data: list
+    """
+    match = re.match(r'\[CAPABILITY ([^\]]*)\]', ensure_str((login_data or [b''])[-1] or b'', 'utf-8', 'replace'),
+                     re.IGNORECASE)
+    if match:
+        capabilities = match.group(1)
+    else:
+        typ, data = mailclient.response('CAPABILITY')
+        if not data or data[-1] is None:
+            typ, data = mailclient.capability()
+            if typ != 'OK' or not data or data[-1] is None:
+                return
+        capabilities = ensure_str(data[-1], 'utf-8', 'replace')
+    mailclient.capabilities = tuple(capabilities.upper().split())
+
+
+def get_imap_uidvalidity(mailclient, folder):
+    """
+    This returns the UIDVALIDITY of the currently selected IMAP folder.
+    :param mailclient: IMAP connection with the folder selected
+    :type mailclient: imaplib.IMAP4
+    :param folder: The folder that was selected
+    :type folder: basestring
+    :return: Returns the UIDVALIDITY value, or None if the server did not report one
+    :rtype: basestring
+    """
+    typ, data = mailclient.response('UIDVALIDITY')
+    if not data or data[0] is None:
+        typ, data = mailclient.status(folder, '(UIDVALIDITY)')
+        if typ != 'OK' or not data or data[0] is None:
+            return None
+        match = re.search(r'UIDVALIDITY\s+(\d+)', ensure_str(data[0]))
+        return match.group(1) if match else None
+    return ensure_str(data[0])
+
+
+def parse_imap_status(data):
+    """
+    This parses the untagged STATUS responses returned by a STATUS command, or by LIST with RETURN (STATUS).
+    :param data: The data list returned by IMAP4.status or IMAP4.response('STATUS')
+    :type data: list
+    :return: Returns a dict mapping folder names to a dict of their status items, such as UIDNEXT, as integers.
+     INBOX is case-insensitive, so it is always returned in upper case.
+    :rtype: dict
+    """
+    statuses = {}
+    name = None
+    for element in data or []:
+        if element is None:
+            continue
+        if isinstance(element, tuple):
+            """Folder name sent as a literal, the status items follow in the next element"""
+            name = ensure_str(element[1], 'utf-8', 'replace')
+            continue
+        line = ensure_str(element, 'utf-8', 'replace')
+        if name is None:
+            match = re.match(r'\s*("(?:[^"\\]|\\.)*"|\S+)', line)
+            if not match:
+                continue
+            name = match.group(1)
+            line = line[match.end():]
+            if name.startswith('"'):
+                name = re.sub(r'\\(.)', r'\1', name[1:-1])
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        statuses[name] = dict((item.upper(), int(value)) for item, value in re.findall(r'([\w-]+)\s+(\d+)', line))
+        name = None
+    return statuses
+
+
+def get_pop_uidls(mailclient):
+    """
+    This lists the unique id of every mail in a POP3 mailbox with a single UIDL command.
+    :param mailclient: Authenticated POP3 connection
+    :type mailclient: poplib.POP3
+    :return: Returns a dict mapping message numbers to their UIDL
+    :rtype: dict
+    """
+    resp, lines, octets = mailclient.uidl()
+    uidls = {}
+    for line in lines:
+        num, uidl = ensure_str(line).split(None, 1)
+        uidls[int(num)] = uidl.strip()
+    return uidls
+
+
+def get_pop_sizes(mailclient):
+    """
+    This lists the size of every mail in a POP3 mailbox with a single LIST command.
+    :param mailclient: Authenticated POP3 connection
+    :type mailclient: poplib.POP3
+    :return: Returns a dict mapping message numbers to their size in octets
+    :rtype: dict
+    """
+    resp, lines, octets = mailclient.list()
+    sizes = {}
+    for line in lines:
+        num, size = ensure_str(line).split()[:2]
+        sizes[int(num)] = int(size)
+    return sizes
+
+
+def spool_pop_mail(mailclient, num, spool):
+    """
+    This retrieves a POP3 mail line by line into a file, where poplib.POP3.retr holds every line of it in a list.
+    Lines are written as retr returns them, without the dot stuffing and with LF line endings.
+    :param mailclient: Authenticated POP3 connection
+    :type mailclient: poplib.POP3
+    :param num: Message number of the mail
+    :type num: int
+    :param spool: Binary file the mail is written to
+    :type spool: file
+    :return: Returns the size of the mail in octets, as counted by retr
+    :rtype: int
+    """
+    mailclient._putcmd('RETR %s' % num)
+    mailclient._getresp()
+    octets = 0
+    line, size = mailclient._getline()
+    while line != b'.':
+        if line.startswith(b'..'):
+            size -= 1
+            line = line[1:]
+        octets += size
+        spool.write(line + b'\n')
+        line, size = mailclient._getline()
+    return octets
+
+
+def build_uid_set(uids):
+    """
+    This compresses a list of UIDs into an IMAP sequence set such as 1001:1025,1030
+    :param uids: UIDs to include in the set
+    :type uids: list
+    :return: Returns the UID set to be used in UID FETCH / STORE commands
+    :rtype: basestring
+    """
+    ranges = []
+    for uid in sorted(set(int(u) for u in uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join('%d' % start if start == end else '%d:%d' % (start, end) for start, end in ranges)
+
+
+def parse_uid_set(uid_set):
+    """
+    This expands an IMAP sequence set such as 1001:1025,1030 into the UIDs it contains.
+    :param uid_set: UID set, as returned in a VANISHED response
+    :type uid_set: basestring
+    :return: Returns the list of UIDs
+    :rtype: list
+    """
+    uids = []
+    for uid_range in ensure_str(uid_set).strip().split(','):
+        if not uid_range:
+            continue
+        start, _, end = uid_range.partition(':')
+        start, end = int(start), int(end or start)
+        uids.extend(range(min(start, end), max(start, end) + 1))
+    return uids
+
+
+def split_uids_by_size(uids, sizes, max_bytes):
+    """
+    This splits a list of UIDs into consecutive groups whose mails add up to at most max_bytes, so that a single
+    FETCH response never holds more than that. A mail larger than max_bytes gets a group of its own, and so does
+    a mail of unknown size.
+    :param uids: UIDs of the mails, in the order they are fetched
+    :type uids: list
+    :param sizes: RFC822.SIZE of the mails
+    :type sizes: dict
+    :param max_bytes: Size budget of a group
+    :type max_bytes: int
+    :return: Returns the list of groups, each a non-empty list of UIDs
+    :rtype: list
+    """
+    groups = []
+    group_size = 0
+    for uid in uids:
+        size = sizes.get(uid, max_bytes)
+        if not groups or group_size + size > max_bytes:
+            groups.append([])
+            group_size = 0
+        groups[-1].append(uid)
+        group_size += size
+    return groups
+
+
+def _tokenize_fetch_segment(segment, tokens):
+    """
+    This splits a piece of an untagged FETCH response into atoms, quoted strings and parentheses.
+    """
+    i = 0
+    length = len(segment)
+    while i < length:
+        c = segment[i]
+        if c == ' ':
+            i += 1
+        elif c in '()':
+            tokens.append(c)
+            i += 1
+        elif c == '"':
+            i += 1
+            value = []
+            while i < length and segment[i] != '"':
+                if segment[i] == '\\':
+                    i += 1
+                value.append(segment[i])
+                i += 1
+            tokens.append(('QUOTED', ''.join(value)))
+            i += 1
+        else:
+            start = i
+            depth = 0
+            while i < length:
+                c = segment[i]
+                if c == '[':
+                    depth += 1
+                elif c == ']':
+                    depth -= 1
+                elif depth == 0 and c in ' ()':
+                    break
+                i += 1
+            tokens.append(segment[start:i])
+
+
+def parse_fetch_response(data):
+    """
+    This parses the data returned by imaplib for a UID FETCH over a UID set.
+    Each message can span several (header, literal) tuples followed by a closing bytes string.
+    :param data: The data list returned by IMAP4.uid('fetch', ...)
+    :type data: list
+    :return: Returns a list of (uid, items) where items maps upper-cased fetch items to their values.
+     Literals are returned as bytes, atoms and quoted strings as text and parenthesized lists as lists.
+    :rtype: list
+    """
+    tokens = []
+    for element in data:
+        if isinstance(element, tuple):
+            _tokenize_fetch_segment(ensure_str(element[0], 'utf-8', 'replace'), tokens)
+            if tokens and isinstance(tokens[-1], text_type) and re.match(r'^\{\d+\}$', tokens[-1]):
+                tokens[-1] = ('LITERAL', element[1])
+            else:
+                tokens.append(('LITERAL', element[1]))
+        elif element is not None:
+            _tokenize_fetch_segment(ensure_str(element, 'utf-8', 'replace'), tokens)
+    messages = []
+    stack = []
+    for token in tokens:
+        if token == '(':
+            new_list = []
+            if stack:
+                stack[-1].append(new_list)
+            stack.append(new_list)
+        elif token == ')':
+            if not stack:
+                continue
+            closed = stack.pop()
+            if not stack:
+                items = {}
+                for key, value in zip(closed[0::2], closed[1::2]):
+                    if isinstance(key, text_type):
+                        items[key.upper()] = value
+                if 'UID' in items:
+                    messages.append((int(items['UID']), items))
+        elif not stack:
+            """Message sequence number or separator between two messages"""
+            continue
+        elif isinstance(token, tuple):
+            stack[-1].append(token[1])
+        elif token.upper() == 'NIL':
+            stack[-1].append(None)
+        else:
+            stack[-1].append(token)
+    return messages
+
+
+def _imap_body_params(params):
+    """
+    This turns the parameter list of a BODYSTRUCTURE part into a dict with upper-cased names.
+    """
+    if not isinstance(params, list):
+        return {}
+    return dict((ensure_str(name).upper(), ensure_str(value) if value is not None else None)
+                for name, value in zip(params[0::2], params[1::2]))
+
+
+def _imap_body_part(body, section):
+    """
+    This parses one part of a BODYSTRUCTURE, and the parts it contains.
+    """
+    if isinstance(body[0], list):
+        parts = []
+        while isinstance(body[len(parts)], list):
+            child_section = '%s.%d' % (section, len(parts) + 1) if section else '%d' % (len(parts) + 1)
+            parts.append(_imap_body_part(body[len(parts)], child_section))
+        params = _imap_body_params(body[len(parts) + 1] if len(body) > len(parts) + 1 else None)
+        return {'section': section, 'boundary': params['BOUNDARY'], 'parts': parts,
+                'skipped': any(part['skipped'] for part in parts)}
+    content_type = ('%s/%s' % (ensure_str(body[0]), ensure_str(body[1]))).lower()
+    if content_type.startswith('message/'):
+        raise ValueError('Attached messages are fetched whole')
+    """The extension data starting with the disposition follows the number of lines of text parts"""
+    extension = 8 if content_type.startswith('text/') else 7
+    disposition = body[extension + 1] if len(body) > extension + 1 else None
+    names = list(_imap_body_params(body[2]))
+    if isinstance(disposition, list) and len(disposition) > 1:
+        names.extend(_imap_body_params(disposition[1]))
+    named = any(name.startswith('NAME') or name.startswith('FILENAME') for name in names)
+    supported = content_type.startswith('text/') or content_type in SUPPORTED_CONTENT_TYPES
+    return {'section': section or '1', 'size': int(body[6]), 'skipped': named or not supported}
+
+
+def parse_imap_bodystructure(bodystructure):
+    """
+    This parses the BODYSTRUCTURE of a multipart mail, to fetch only the parts that are indexed when
+    attachments are dropped. Parts with a file name, and parts whose content type is not indexed, are skipped.
+    :param bodystructure: BODYSTRUCTURE of the mail, as returned by parse_fetch_response
+    :type bodystructure: list
+    :return: Returns the parts of the mail, or None if it is not a multipart mail, if no part would be skipped,
+     or if the structure could not be parsed
+    :rtype: dict
+    """
+    try:
+        if not isinstance(bodystructure, list) or not isinstance(bodystructure[0], list):
+            return None
+        structure = _imap_body_part(bodystructure, '')
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+    return structure if structure['skipped'] else None
+
+
+def get_imap_partial_items(structure, max_section=0):
+    """
+    :param structure: Parts of a mail, as returned by parse_imap_bodystructure
+    :type structure: dict
+    :param max_section: When set, only the first max_section bytes of larger parts are fetched
+    :type max_section: int
+    :return: Returns the FETCH items needed to rebuild a mail without its skipped parts: the header of the mail,
+     the MIME header of every part, and the content of the parts that are not skipped
+    :rtype: list
+    """
+    items = ['BODY.PEEK[HEADER]'] if not structure['section'] else [
+        'BODY.PEEK[%s.MIME]' % structure['section']]
+    if 'parts' in structure:
+        for part in structure['parts']:
+            items.extend(get_imap_partial_items(part, max_section))
+    elif not structure['skipped']:
+        if max_section and structure['size'] > max_section:
+            items.append('BODY.PEEK[%s]<0.%d>' % (structure['section'], max_section))
+        else:
+            items.append('BODY.PEEK[%s]' % structure['section'])
+    return items
+
+
+def build_imap_partial_mail(structure, message_data):
+    """
+    This rebuilds a mail from the sections fetched with get_imap_partial_items. Skipped parts keep their MIME
+    header, and get an empty body and a SKIPPED_PART_HEADER holding their size on the server.
+    :param structure: Parts of the mail, as returned by parse_imap_bodystructure
+    :type structure: dict
+    :param message_data: The fetch items of the mail, as returned by parse_fetch_response
+    :type message_data: dict
+    :return: Returns the rebuilt mail, or None if a section is missing from the fetch response
+    :rtype: bytes
+    """
+    header = message_data.get('BODY[HEADER]' if not structure['section'] else 'BODY[%s.MIME]' % structure['section'])
+    if header is None:
+        return None
+    header = header.rstrip(b'\r\n')
+    header = header + b'\r\n' if header else b''
+    if 'parts' in structure:
+        boundary = structure['boundary'].encode('ascii')
+        data = [header, b'\r\n']
+        for part in structure['parts']:
+            part_data = build_imap_partial_mail(part, message_data)
+            if part_data is None:
+                return None
+            data.extend([b'--', boundary, b'\r\n', part_data, b'\r\n'])
+        data.extend([b'--', boundary, b'--\r\n'])
+        return b''.join(data)
+    if structure['skipped']:
+        return header + ('%s: %d\r\n\r\n' % (SKIPPED_PART_HEADER, structure['size'])).encode('ascii')
+    content = message_data.get('BODY[%s]' % structure['section'])
+    if content is None:
+        content = message_data.get('BODY[%s]<0>' % structure['section'])
+    if content is None:
+        return None
+    return header + b'\r\n' + content
+
+
+def get_imap_delivery_time(message_data):
+    """
+    This returns when the server received a mail, from the INTERNALDATE of a FETCH response.
+    :param message_data: The fetch items of the mail, as returned by parse_fetch_response
+    :type message_data: dict
+    :return: Returns the delivery time in seconds since the epoch, or None if it was not fetched
+    :rtype: float
+    """
+    internaldate = message_data.get('INTERNALDATE')
+    if not internaldate:
+        return None
+    delivery_time = imaplib.Internaldate2tuple(('INTERNALDATE "%s"' % internaldate).encode('ascii', 'replace'))
+    return time.mktime(delivery_time) if delivery_time else None
+
+
+def spool_imap_mail(mailclient, uid, spool, chunk_size):
+    """
+    This fetches a mail into a file, chunk_size bytes at a time with BODY.PEEK[]<offset.size> partial fetches,
+    so that no response holds more than a chunk of it.
+    :param mailclient: IMAP connection with the folder selected
+    :type mailclient: imaplib.IMAP4
+    :param uid: UID of the mail
+    :type uid: int
+    :param spool: Binary file the mail is written to
+    :type spool: file
+    :param chunk_size: Number of bytes fetched at a time
+    :type chunk_size: int
+    :return: Returns the fetch items of the first chunk, which hold the INTERNALDATE of the mail, an empty dict
+     if the mail is no longer in the folder, or None if a FETCH failed
+    :rtype: dict
+    """
+    first = None
+    offset = 0
+    while True:
+        result, email_data = mailclient.uid('fetch', '%d' % uid,
+                                            '(UID INTERNALDATE BODY.PEEK[]<%d.%d>)' % (offset, chunk_size))
+        if result != 'OK':
+            return None
+        message_data = dict(parse_fetch_response(email_data)).get(uid)
+        del email_data
+        if message_data is None:
+            """The mail was expunged while it was fetched"""
+            spool.seek(0)
+            spool.truncate()
+            return {}
+        chunk = message_data.pop('BODY[]<%d>' % offset, None) or b''
+        if first is None:
+            first = message_data
+        spool.write(chunk)
+        offset += len(chunk)
+        if len(chunk) < chunk_size:
+            return first
+
+
+def imap_idle(mailclient, timeout):
+    """
+    This waits in IDLE (RFC 2177) on the selected folder until the server reports new or expunged mails,
+    or until timeout. imaplib has no IDLE command, so it is sent and ended with DONE on the connection itself.
+    Expunged mails are reported by VANISHED instead of EXPUNGE once QRESYNC is enabled.
+    :param mailclient: IMAP connection with the folder selected, whose server supports IDLE
+    :type mailclient: imaplib.IMAP4
+    :param timeout: Maximum number of seconds to stay in IDLE
+    :type timeout: float
+    :return: Returns True if an EXISTS, EXPUNGE or VANISHED response was received
+    :rtype: bool
+    """
+    changed_response = br'\*\s+(\d+\s+(EXISTS|EXPUNGE)|VANISHED)'
+    tag = mailclient._new_tag()
+    mailclient.send(tag + b' IDLE\r\n')
+    changed = False
+    line = mailclient.readline()
+    while line.startswith(b'* '):
+        changed = changed or re.match(changed_response, line, re.IGNORECASE) is not None
+        line = mailclient.readline()
+    if not line.startswith(b'+'):
+        del mailclient.tagged_commands[tag]
+        raise mailclient.error("IDLE rejected: %s" % ensure_str(line.strip(), errors='replace'))
+    deadline = time.time() + timeout
+    read_timeout = mailclient.sock.gettimeout()
+    try:
+        while not changed and deadline > time.time():
+            """The deadline can pass after the check, and socket timeouts cannot be negative or 0 (non-blocking)"""
+            mailclient.sock.settimeout(max(0.001, deadline - time.time()))
+            try:
+                line = mailclient.readline()
+            except socket.timeout:
+                """Nothing was received, but the timed out file object of the socket cannot be read anymore"""
+                mailclient.file = mailclient.sock.makefile('rb')
+                break
+            if not line or line.startswith(b'* BYE'):
+                raise mailclient.abort("Connection closed in IDLE: %s" % ensure_str(line.strip(), errors='replace'))
+            changed = re.match(changed_response, line, re.IGNORECASE) is not None
+    finally:
+        mailclient.sock.settimeout(read_timeout)
+    mailclient.send(b'DONE\r\n')
+    while True:
+        line = mailclient.readline()
+        if not line:
+            raise mailclient.abort("Connection closed ending IDLE")
+        if line.startswith(tag + b' '):
+            break
+    del mailclient.tagged_commands[tag]
+    if not line[len(tag):].strip().upper().startswith(b'OK'):
+        raise mailclient.error("IDLE failed: %s" % ensure_str(line.strip(), errors='replace'))
+    return changed
+
+
 def get_mail_port(protocol):
     """
     This returns the server port to use for POP retrieval of mails
@@ -106,4 +583,45 @@ def drop_attachment_from_event(message):
     :rtype: basestring
     """
     pattern = r'^#BEGIN_ATTACHMENT:\s(.*)#END_ATTACHMENT:\s'
-    return re.sub(pattern, "", message, flags=re.DOTALL|re.MULTILINE)
\ No newline at end of file
+    return re.sub(pattern, "", message, flags=re.DOTALL|re.MULTILINE)
+
+
+def get_mail_size(raw_email):
+    """
+    :param raw_email: The mail as fetched, either as bytes (IMAP), as a list of lines (POP3) or spooled to a file
+    :type raw_email: Union[bytes, list, file]
+    :return: Returns the size of the mail in bytes, counting a CRLF at the end of every POP3 line
+    :rtype: int
+    """
+    if isinstance(raw_email, binary_type):
+        return len(raw_email)
+    if isinstance(raw_email, text_type):
+        return len(raw_email.encode('utf-8'))
+    if hasattr(raw_email, 'seek'):
+        raw_email.seek(0, 2)
+        return raw_email.tell()
+    return sum(len(line) + 2 for line in raw_email)
+
+
+def truncate_event(message, max_size, mail_size, truncated=False):
+    """
+    This cuts an event to max_size bytes, which is what TRUNCATE in props.conf keeps of it, and ends it with
+    a #TRUNCATED line giving the size of the mail and how much of the event was kept. The line is also
+    added to events that fit, when only the start of the mail was fetched.
+    :param message: Email message to be ingested as event in Splunk
+    :type message: basestring
+    :param max_size: Maximum size of the event in bytes, including the #TRUNCATED line
+    :type max_size: int
+    :param mail_size: Size of the mail in bytes
+    :type mail_size: int
+    :param truncated: Whether only the start of the mail was fetched
+    :type truncated: bool
+    :return: Returns the event, cut to max_size bytes if it is larger
+    :rtype: basestring
+    """
+    encoded = message.encode('utf-8')
+    if len(encoded) <= max_size and not truncated:
+        return message
+    marker = '\n#TRUNCATED: mail_size = %d ; indexed_size = %%d' % mail_size
+    kept = encoded[:max(max_size - len(marker % max_size), 0)].decode('utf-8', 'ignore')
+    return kept + marker % len(kept.encode('utf-8'))
@@ -0,0 +1,56 @@
+from __future__ import unicode_literals
+
+import io
+
+from file_parser import email_mime
+
+TEXT = 'Grüße aus Köln'
+
+RAW_EMAIL = (b'\r\nFrom: a@example.com\r\nSubject: =?utf-8?q?Gr=C3=BC=C3=9Fe?=\r\n'
+             b'Date: Fri, 17 Jul 2020 02:44:25 -0700\r\nMessage-ID: <a@example.com>\r\nMIME-Version: 1.0\r\n'
+             b'Content-Type: multipart/mixed; boundary="BB"\r\n\r\n--BB\r\n'
+             b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: 8bit\r\n\r\n' +
+             TEXT.encode('utf-8') +
+             b'\r\n--BB\r\nContent-Type: application/octet-stream; name="x.bin"\r\n'
+             b'Content-Transfer-Encoding: base64\r\nContent-Disposition: attachment; filename="x.bin"\r\n\r\n'
+             b'aGVsbG8=\r\n--BB--\r\n')
+
+
+def parse(raw_email, maintain_rfc=False):
+    return email_mime.parse_email(raw_email, True, maintain_rfc, False)
+
+
+def test_parses_bytes_lines_and_files_alike():
+    """IMAP fetches bytes, POP3 a list of lines without their line ends, and large mails are spooled to a file"""
+    expected = parse(RAW_EMAIL)
+    assert expected[0] == 1594979065.0
+    assert expected[1] == '<a@example.com>'
+    assert 'Subject: Grüße' in expected[2]
+    assert TEXT in expected[2]
+    assert parse(RAW_EMAIL.split(b'\r\n')) == expected
+    assert parse(io.BytesIO(RAW_EMAIL)) == expected
+
+
+def test_parses_mails_with_maintain_rfc():
+    assert TEXT in parse(RAW_EMAIL, True)[2]
+    """Mails parsed from a string may hold characters that only utf-8 can write"""
+    assert TEXT in parse(RAW_EMAIL.decode('utf-8'), True)[2]
+
+
+def test_parses_nothing_from_an_empty_mail():
+    assert parse(b'') == [None, None, None]
+    assert email_mime.message_from_raw(io.BytesIO(b'\r\n\r\n')) is None
+
+
+def get_hash_lines(event):
+    return [line for line in event.splitlines() if line.split(' = ')[0] in ('md5', 'sha1', 'sha256')]
+
+
+def test_hashes_attachments_in_both_output_modes():
+    hash_lines = ['md5 = 5d41402abc4b2a76b9719d911017c592',
+                  'sha256 = 2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824']
+    assert get_hash_lines(parse(RAW_EMAIL)[2]) == hash_lines
+    assert get_hash_lines(parse(RAW_EMAIL, True)[2]) == hash_lines
+    assert get_hash_lines(email_mime.parse_email(RAW_EMAIL, True, False, False, ['sha1'])[2]) == [
+        'sha1 = aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d']
+    assert get_hash_lines(email_mime.parse_email(RAW_EMAIL, True, False, False, [])[2]) == []
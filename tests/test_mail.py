@@ -0,0 +1,258 @@
+from __future__ import unicode_literals
+
+import importlib.util
+import os
+
+import pytest
+
+from mail_checkpoint import CheckpointStore
+from mail_utils import parse_uid_set
+
+spec = importlib.util.spec_from_file_location('mail', os.path.join(os.path.dirname(__file__), '..', 'bin', 'mail.py'))
+mail = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mail)
+
+
+def build_mail(i):
+    return (b'From: a@example.com\r\nTo: u@example.com\r\nSubject: mail %d\r\n'
+            b'Date: Fri, 17 Jul 2020 02:44:25 -0700\r\nMessage-ID: <%d@example.com>\r\n\r\nhello %d\r\n' % (i, i, i))
+
+
+class FakeIMAP(object):
+    """An IMAP connection with a single folder, which records the UIDs of the mails it returns"""
+
+    capabilities = ('IMAP4REV1', 'UIDPLUS')
+    qresync = False
+    compression = None
+
+    def __init__(self, uidvalidity, mails):
+        self.uidvalidity = uidvalidity
+        self.mails = mails
+        self.fetched = []
+        self.prefix_fetched = []
+        self.deleted = []
+
+    def select(self, folder, readonly=False):
+        return 'OK', [b'%d' % len(self.mails)]
+
+    def response(self, code):
+        if code == 'UIDVALIDITY':
+            return code, [b'%d' % self.uidvalidity]
+        return code, [None]
+
+    def uid(self, command, *args):
+        if command == 'search':
+            uids = sorted(self.mails)
+            if args[1] != 'ALL':
+                first = int(args[1].split()[1].split(':')[0])
+                uids = [uid for uid in uids if uid >= first] or uids[-1:]
+            return 'OK', [b' '.join(b'%d' % uid for uid in uids)]
+        if command == 'fetch':
+            return 'OK', self.fetch(parse_uid_set(args[0]), args[1])
+        if command == 'store':
+            self.deleted.extend(parse_uid_set(args[0]))
+        elif command == 'expunge':
+            for uid in parse_uid_set(args[0]):
+                self.mails.pop(uid, None)
+        return 'OK', [None]
+
+    def fetch(self, uids, items):
+        data = []
+        for uid in uids:
+            if uid not in self.mails:
+                continue
+            raw_email = self.mails[uid]
+            if 'HEADER.FIELDS' in items:
+                header = b''.join(line + b'\r\n' for line in raw_email.split(b'\r\n')
+                                  if line.lower().startswith((b'message-id:', b'date:'))) + b'\r\n'
+                data.append((b'%d (UID %d RFC822.SIZE %d BODY[HEADER.FIELDS (MESSAGE-ID DATE)] {%d}' % (
+                    uid, uid, len(raw_email), len(header)), header))
+            elif 'BODY.PEEK[]<0.' in items:
+                prefix = raw_email[:int(items.split('<0.')[1].split('>')[0])]
+                self.prefix_fetched.append(uid)
+                data.append((b'%d (UID %d BODY[]<0> {%d}' % (uid, uid, len(prefix)), prefix))
+            elif 'BODY.PEEK[' in items:
+                """Sections are not returned, as when a mail changed since its BODYSTRUCTURE was read"""
+                data.append(b'%d (UID %d)' % (uid, uid))
+                continue
+            else:
+                self.fetched.append(uid)
+                data.append((b'%d (UID %d RFC822 {%d}' % (uid, uid, len(raw_email)), raw_email))
+            data.append(b')')
+        return data
+
+
+class FakePOP(object):
+    """A POP3 mailbox, which records the commands that read or delete mails"""
+
+    def __init__(self, mails):
+        self.mails = mails
+        self.commands = []
+
+    def set_debuglevel(self, level):
+        pass
+
+    def user(self, username):
+        return b'+OK'
+
+    def pass_(self, password):
+        return b'+OK'
+
+    def stat(self):
+        return len(self.mails), sum(len(raw_email) for raw_email in self.mails)
+
+    def uidl(self):
+        return b'+OK', [b'%d uidl-%s' % (num, raw_email.split(b'<')[1].split(b'@')[0])
+                        for num, raw_email in enumerate(self.mails, 1)], 0
+
+    def top(self, num, lines):
+        self.commands.append(('top', num))
+        raw_email = self.mails[num - 1]
+        return b'+OK', raw_email.split(b'\r\n\r\n')[0].split(b'\r\n'), len(raw_email)
+
+    def retr(self, num):
+        self.commands.append(('retr', num))
+        raw_email = self.mails[num - 1]
+        return b'+OK', raw_email.split(b'\r\n'), len(raw_email)
+
+    def dele(self, num):
+        self.commands.append(('dele', num))
+
+    def quit(self):
+        self.commands.append(('quit',))
+
+
+class FakeConnections(object):
+
+    def __init__(self, mailclient):
+        self.mailclient = mailclient
+
+    def connect(self, server, protocol, user, connect_timeout, read_timeout):
+        return self.mailclient
+
+    def save_session(self, server, protocol, mailclient):
+        pass
+
+    def discard(self, mailclient):
+        pass
+
+
+class Credential(object):
+    username = 'u@example.com'
+    clear_password = 'secret'
+
+
+@pytest.fixture
+def create_input(tmp_path):
+    checkpoints = CheckpointStore(str(tmp_path))
+
+    def create(protocol='IMAP', **input_item):
+        mail_input = mail.Mail()
+        mail_input.events = []
+        mail_input.log = lambda level, message: None
+        mail_input.write_event = mail_input.events.append
+        mail_input.get_credential = lambda: Credential()
+        input_item.update(mailserver='mail.example.com', password='secret', protocol=protocol)
+        mail_input.configure('mail://u@example.com', input_item, str(tmp_path))
+        mail_input.checkpoints = checkpoints
+        return mail_input
+
+    yield create
+    checkpoints.close()
+
+
+def sync_folder(mail_input, mailclient):
+    mail_input.events = []
+    mail_input.write_event = mail_input.events.append
+    mail_input.stream_imap_folder(mailclient, 'INBOX', mail_input.imap_readonly())
+    return [event.data for event in mail_input.events]
+
+
+def test_imap_resyncs_a_folder_after_uidvalidity_changed(create_input):
+    mail_input = create_input()
+    mailclient = FakeIMAP(1, {uid: build_mail(uid) for uid in (1, 2, 3)})
+    assert len(sync_folder(mail_input, mailclient)) == 3
+    assert mail_input.checkpoints.load_folder_cursor('u@example.com', 'INBOX') == ('1', 3)
+    mailclient.mails[4] = build_mail(4)
+    assert len(sync_folder(mail_input, mailclient)) == 1
+    assert mailclient.fetched == [1, 2, 3, 4]
+    """The folder was recreated: UIDs start again from 1, while UID 4:* would only match the highest UID"""
+    mailclient = FakeIMAP(2, {1: build_mail(5), 2: build_mail(6)})
+    assert len(sync_folder(mail_input, mailclient)) == 2
+    assert mailclient.fetched == [1, 2]
+    assert mail_input.checkpoints.load_folder_cursor('u@example.com', 'INBOX') == ('2', 2)
+
+
+def test_imap_fetches_only_mails_whose_message_id_is_new(create_input):
+    mail_input = create_input()
+    mail_input.checkpoints.save_checkpoint('<2@example.com>', ['u@example.com', 'INBOX', '1', 2])
+    mailclient = FakeIMAP(1, {uid: build_mail(uid) for uid in (1, 2, 3)})
+    events = sync_folder(mail_input, mailclient)
+    assert mailclient.fetched == [1, 3]
+    assert len(events) == 2
+    assert 'hello 1' in events[0] and 'hello 3' in events[1]
+
+
+def test_imap_delayed_cleanup_deletes_mails_of_the_previous_run(create_input):
+    mail_input = create_input(mailbox_cleanup='delayed')
+    mailclient = FakeIMAP(1, {uid: build_mail(uid) for uid in (1, 2, 3)})
+    assert len(sync_folder(mail_input, mailclient)) == 3
+    assert mailclient.deleted == []
+    mailclient.mails[4] = build_mail(4)
+    assert len(sync_folder(mail_input, mailclient)) == 1
+    """Mails indexed by the previous run are deleted from their UIDs, without being fetched again"""
+    assert mailclient.deleted == [1, 2, 3]
+    assert mailclient.fetched == [1, 2, 3, 4]
+    assert sorted(mailclient.mails) == [4]
+
+
+def test_pop_skips_mails_whose_uidl_was_indexed(create_input):
+    mail_input = create_input('POP3')
+    mailclient = FakePOP([build_mail(i) for i in (1, 2)])
+    mail_input.connections = FakeConnections(mailclient)
+    mail_input.stream_pop_emails()
+    assert len(mail_input.events) == 2
+    assert mailclient.commands == [('top', 1), ('retr', 1), ('top', 2), ('retr', 2), ('quit',)]
+    mailclient = FakePOP([build_mail(i) for i in (1, 2, 3)])
+    mail_input.connections = FakeConnections(mailclient)
+    mail_input.stream_pop_emails()
+    assert len(mail_input.events) == 3
+    assert mailclient.commands == [('top', 3), ('retr', 3), ('quit',)]
+
+
+def test_events_carry_the_stanza_of_their_input(create_input):
+    """The single instance writes the events of every input to one stream, where the stanza tells them apart"""
+    mail_input = create_input()
+    sync_folder(mail_input, FakeIMAP(1, {1: build_mail(1)}))
+    mail_input.connections = FakeConnections(FakePOP([build_mail(2)]))
+    mail_input.stream_pop_emails()
+    assert [event.stanza for event in mail_input.events] == ['mail://u@example.com'] * 2
+
+
+def test_pop_commits_checkpoints_after_every_batch(create_input):
+    mail_input = create_input('POP3', fetch_batch_size='2')
+    mail_input.connections = FakeConnections(FakePOP([build_mail(i) for i in range(5)]))
+    commits = []
+    commit = mail_input.checkpoints.commit
+
+    def record_commit():
+        commits.append(len(mail_input.events))
+        commit()
+
+    mail_input.checkpoints.commit = record_commit
+    mail_input.stream_pop_emails()
+    assert commits == [2, 4]
+
+
+def test_imap_fetches_mails_that_could_not_be_rebuilt_within_the_same_limits(create_input):
+    mail_input = create_input(drop_attachment='1', attachment_hashes='none', max_event_size='100')
+    mailclient = FakeIMAP(1, {1: build_mail(1) + b'x' * 1000, 2: build_mail(2)})
+    structure = {'section': '', 'boundary': 'BB', 'skipped': True, 'parts': [
+        {'section': '1', 'size': 12, 'skipped': False}, {'section': '2', 'size': 900, 'skipped': True}]}
+    sizes = {uid: len(raw_email) for uid, raw_email in mailclient.mails.items()}
+    mails = mail_input.imap_fetch_mails(mailclient, [1, 2], {1: structure, 2: structure}, sizes)
+    """Only the start of the larger mail is fetched, as it would have been without its BODYSTRUCTURE"""
+    assert mailclient.prefix_fetched == [1]
+    assert mailclient.fetched == [2]
+    assert [(mail[0], len(mail[1]), mail[3], mail[5]) for mail in mails] == [(1, 400, False, True),
+                                                                             (2, len(build_mail(2)), False, False)]
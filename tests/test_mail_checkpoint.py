@@ -0,0 +1,152 @@
+from __future__ import unicode_literals
+
+import os
+import time
+
+import pytest
+
+from mail_checkpoint import CheckpointStore, get_checkpoint_digest
+
+
+@pytest.fixture
+def store(tmp_path):
+    checkpoints = CheckpointStore(str(tmp_path))
+    yield checkpoints
+    checkpoints.close()
+
+
+def test_migrates_empty_checkpoint_files(tmp_path):
+    digest = get_checkpoint_digest('<old@example.com>')
+    open(os.path.join(str(tmp_path), digest), 'w').close()
+    open(os.path.join(str(tmp_path), 'notes.txt'), 'w').close()
+    checkpoints = CheckpointStore(str(tmp_path))
+    try:
+        assert checkpoints.locate_checkpoint('<old@example.com>')
+        assert not checkpoints.locate_checkpoint('<new@example.com>')
+    finally:
+        checkpoints.close()
+    assert sorted(name for name in os.listdir(str(tmp_path)) if not name.startswith('mail_checkpoint.db')) == [
+        'notes.txt']
+
+
+def test_migrates_only_once(tmp_path):
+    CheckpointStore(str(tmp_path)).close()
+    digest = get_checkpoint_digest('<late@example.com>')
+    open(os.path.join(str(tmp_path), digest), 'w').close()
+    checkpoints = CheckpointStore(str(tmp_path))
+    try:
+        assert not checkpoints.locate_checkpoint('<late@example.com>')
+    finally:
+        checkpoints.close()
+    assert os.path.exists(os.path.join(str(tmp_path), digest))
+
+
+def test_checkpoints_survive_reopening(tmp_path, store):
+    store.save_checkpoint('<a@example.com>', ['u@x.com', 'INBOX', '1', 5])
+    assert store.locate_checkpoint('<a@example.com>')
+    store.close()
+    checkpoints = CheckpointStore(str(tmp_path))
+    try:
+        assert checkpoints.locate_checkpoint('<a@example.com>')
+        assert not checkpoints.locate_checkpoint('<b@example.com>')
+    finally:
+        checkpoints.close()
+
+
+def test_folder_cursor(store):
+    assert store.load_folder_cursor('u@x.com', 'INBOX') == (None, 0)
+    assert store.load_folder_status('u@x.com', 'INBOX') == (None, None, None, None)
+    store.save_folder_cursor('u@x.com', 'INBOX', 7, 42)
+    assert store.load_folder_cursor('u@x.com', 'INBOX') == ('7', 42)
+    assert store.load_folder_status('u@x.com', 'INBOX') == ('7', None, None, None)
+    store.save_folder_cursor('u@x.com', 'INBOX', 7, 50, 51, 20, 900)
+    assert store.load_folder_cursor('u@x.com', 'INBOX') == ('7', 50)
+    assert store.load_folder_status('u@x.com', 'INBOX') == ('7', 51, 20, 900)
+    assert store.load_folder_cursor('u@x.com', 'Other') == (None, 0)
+
+
+def test_pending_deletes_and_pop_uidls(store):
+    assert store.load_pending_deletes('u@x.com', 'INBOX') == (None, [])
+    store.save_pending_deletes('u@x.com', 'INBOX', 7, [3, 4])
+    assert store.load_pending_deletes('u@x.com', 'INBOX') == ('7', ['3', '4'])
+    store.save_pending_deletes('u@x.com', 'INBOX', 7, [])
+    assert store.load_pending_deletes('u@x.com', 'INBOX') == (None, [])
+    store.save_pop_uidls('u@x.com', ['a', 'b'])
+    store.save_pop_uidls('u@x.com', ['b', 'c'])
+    assert store.load_pop_uidls('u@x.com') == {'b', 'c'}
+
+
+def test_compact_removes_old_checkpoints(store):
+    for i in range(3):
+        store.save_checkpoint('<%d@example.com>' % i, ['u@x.com', 'INBOX', '1', i])
+    store.commit()
+    store.connection.execute('UPDATE checkpoints SET indexed_at = ? WHERE uid IN (?, ?)',
+                             (time.time() - 10 * 86400, '0', '1'))
+    assert store.compact('u@x.com', 5, 5) == 2
+    assert not store.locate_checkpoint('<0@example.com>')
+    assert not store.locate_checkpoint('<1@example.com>')
+    assert store.locate_checkpoint('<2@example.com>')
+
+
+def test_compact_removes_mails_missing_from_the_server(store):
+    for i in range(4):
+        store.save_checkpoint('<%d@example.com>' % i, ['u@x.com', 'INBOX', '1', i])
+    store.save_checkpoint('<other@example.com>', ['v@x.com', 'INBOX', '1', 1])
+    store.record_server_listing('u@x.com', 'INBOX', '1', [2, 3])
+    assert store.compact('u@x.com', 0, 5) == 2
+    assert [store.locate_checkpoint('<%d@example.com>' % i) for i in range(4)] == [False, False, True, True]
+    assert store.locate_checkpoint('<other@example.com>')
+
+
+def test_compact_forgets_listings_of_earlier_runs(store):
+    for i in range(4):
+        store.save_checkpoint('<%d@example.com>' % i, ['u@x.com', 'INBOX', '1', i])
+    store.record_server_listing('u@x.com', 'INBOX', '1', [2, 3])
+    store.record_server_listing('v@x.com', 'INBOX', '1', [])
+    assert store.compact('u@x.com', 0, 5) == 2
+    """Mails indexed since are kept by the next runs, which did not list the folder"""
+    store.save_checkpoint('<4@example.com>', ['u@x.com', 'INBOX', '1', 4])
+    assert store.compact('u@x.com', 0, 5) == 0
+    store.save_checkpoint('<5@example.com>', ['u@x.com', 'INBOX', '1', 5])
+    store.record_server_listing('u@x.com', 'INBOX', '1', [2, 3, 4])
+    """The folder was recreated later in the same run, so only its last listing holds"""
+    store.record_server_listing('u@x.com', 'INBOX', '2', [1])
+    store.save_checkpoint('<6@example.com>', ['u@x.com', 'INBOX', '2', 1])
+    assert store.compact('u@x.com', 0, 5) == 4
+    assert [store.locate_checkpoint('<%d@example.com>' % i) for i in range(7)] == [False] * 6 + [True]
+    assert list(store.listed_folders) == [('v@x.com', 'INBOX')]
+    assert store.connection.execute('SELECT count(*) FROM server_listing').fetchone()[0] == 0
+
+
+def test_compact_removes_vanished_mails(store):
+    for i in range(3):
+        store.save_checkpoint('<%d@example.com>' % i, ['u@x.com', 'INBOX', '1', i])
+    store.record_vanished('u@x.com', 'INBOX', '1', [1])
+    assert store.compact('u@x.com', 0, 5) == 1
+    assert [store.locate_checkpoint('<%d@example.com>' % i) for i in range(3)] == [True, False, True]
+
+
+def test_compact_forgets_vanished_mails_of_earlier_runs(store):
+    for i in range(5):
+        store.save_checkpoint('<%d@example.com>' % i, ['u@x.com', 'INBOX', '1', i])
+    store.record_server_listing('u@x.com', 'INBOX', '1', [0, 1, 2, 3])
+    """A later sync in the same run reports what vanished since, and the listing misses the mails indexed since"""
+    store.record_vanished('u@x.com', 'INBOX', '1', [0])
+    store.record_vanished('u@x.com', 'INBOX', '1', [1])
+    assert store.compact('u@x.com', 0, 5) == 2
+    assert [store.locate_checkpoint('<%d@example.com>' % i) for i in range(5)] == [False, False, True, True, True]
+    store.save_checkpoint('<0@example.com>', ['u@x.com', 'INBOX', '1', 0])
+    assert store.compact('u@x.com', 0, 5) == 0
+    assert store.vanished_folders == {}
+    assert store.connection.execute('SELECT count(*) FROM vanished').fetchone()[0] == 0
+
+
+def test_compact_rebuilds_a_drifted_bloom_filter(store):
+    for i in range(20):
+        store.save_checkpoint('<%d@example.com>' % i, ['u@x.com', 'INBOX', '1', i])
+    store.record_server_listing('u@x.com', 'INBOX', '1', [19])
+    generation = store.get_metadata('bloom_generation')
+    assert store.compact('u@x.com', 0, 5) == 19
+    assert store.get_metadata('bloom_generation') != generation
+    assert not store.locate_checkpoint('<0@example.com>')
+    assert store.locate_checkpoint('<19@example.com>')
@@ -0,0 +1,126 @@
+from __future__ import unicode_literals
+
+import random
+import threading
+import time
+
+import pytest
+
+from mail_pipeline import MailPipeline, parse_mail
+
+
+def test_writes_in_fetch_order():
+    written = []
+
+    def parse(mail):
+        time.sleep(random.random() / 100)
+        return mail * 2
+
+    pipeline = MailPipeline(parse, lambda mail, result: written.append((mail, result)), workers=4)
+    try:
+        for i in range(50):
+            pipeline.put(i)
+        pipeline.join()
+    finally:
+        pipeline.close()
+    assert written == [(i, i * 2) for i in range(50)]
+
+
+def test_calls_run_after_earlier_mails():
+    events = []
+    pipeline = MailPipeline(lambda mail: mail, lambda mail, result: events.append(mail), workers=3)
+    try:
+        pipeline.put(1)
+        pipeline.put(2)
+        pipeline.call(lambda: events.append('commit'))
+        pipeline.put(3)
+        pipeline.join()
+    finally:
+        pipeline.close()
+    assert events == [1, 2, 'commit', 3]
+
+
+def put_in_thread(pipeline, mail, size=0):
+    thread = threading.Thread(target=pipeline.put, args=(mail, size))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_blocks_fetching_at_max_mails():
+    release = threading.Event()
+
+    def parse(mail):
+        release.wait(5)
+        return mail
+
+    pipeline = MailPipeline(parse, lambda mail, result: None, workers=1, max_mails=2)
+    try:
+        pipeline.put(1)
+        pipeline.put(2)
+        thread = put_in_thread(pipeline, 3)
+        thread.join(0.2)
+        assert thread.is_alive()
+        release.set()
+        thread.join(5)
+        assert not thread.is_alive()
+        pipeline.join()
+    finally:
+        release.set()
+        pipeline.close()
+
+
+def test_blocks_fetching_at_max_bytes():
+    release = threading.Event()
+
+    def parse(mail):
+        release.wait(5)
+        return mail
+
+    pipeline = MailPipeline(parse, lambda mail, result: None, workers=1, max_bytes=100)
+    try:
+        """A single mail larger than max_bytes is still accepted"""
+        pipeline.put(1, 150)
+        thread = put_in_thread(pipeline, 2, 10)
+        thread.join(0.2)
+        assert thread.is_alive()
+        release.set()
+        thread.join(5)
+        assert not thread.is_alive()
+        pipeline.join()
+    finally:
+        release.set()
+        pipeline.close()
+
+
+def test_join_raises_the_first_error():
+    written = []
+
+    def parse(mail):
+        if mail == 3:
+            raise ValueError('boom')
+        return mail
+
+    pipeline = MailPipeline(parse, lambda mail, result: written.append(mail), workers=2)
+    try:
+        for i in range(6):
+            pipeline.put(i)
+        with pytest.raises(ValueError):
+            pipeline.join()
+    finally:
+        pipeline.close()
+    assert written == [0, 1, 2]
+
+
+def test_parse_mail_cuts_events_to_max_event_size():
+    raw_email = (b'From: a@example.com\r\nDate: Fri, 17 Jul 2020 02:44:25 -0700\r\nMessage-ID: <a@example.com>\r\n'
+                 b'\r\n' + b'hello world\r\n' * 100)
+    message_time, message_mid, event = parse_mail(raw_email, True, False, False, [], False)
+    assert event.count('hello world') == 100
+    message_time, message_mid, event = parse_mail(raw_email, True, False, False, [], False, False, 200)
+    assert message_mid == '<a@example.com>'
+    assert len(event.encode('utf-8')) <= 200
+    assert event.endswith('\n#TRUNCATED: mail_size = %d ; indexed_size = %d' % (len(raw_email), event.index('\n#')))
+    """Mails fetched in part are marked even when they fit, with the size of the whole mail"""
+    event = parse_mail(raw_email[:150], True, False, False, [], False, False, 200, 5000, True)[2]
+    assert event.endswith('\n#TRUNCATED: mail_size = 5000 ; indexed_size = %d' % event.index('\n#'))
@@ -0,0 +1,55 @@
+from __future__ import unicode_literals
+
+import functools
+import threading
+import time
+
+from mail_scheduler import InputScheduler
+
+
+def test_runs_at_most_max_concurrency_inputs_at_once():
+    scheduler = InputScheduler(lambda level, message: None, max_concurrency=2)
+    lock = threading.Lock()
+    running = []
+    peaks = []
+    done = []
+
+    def run(name):
+        with lock:
+            running.append(name)
+            peaks.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(name)
+            done.append(name)
+            if len(done) == 6:
+                scheduler.stop()
+
+    for i in range(6):
+        scheduler.add('mailbox%d' % i, 3600, functools.partial(run, i))
+    thread = threading.Thread(target=scheduler.run)
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert sorted(done) == list(range(6))
+    assert max(peaks) == 2
+
+
+def test_runs_inputs_again_after_their_interval():
+    scheduler = InputScheduler(lambda level, message: None)
+    runs = []
+
+    def run():
+        runs.append(time.time())
+        if len(runs) == 3:
+            scheduler.stop()
+
+    scheduler.add('mailbox', 0.05, run)
+    thread = threading.Thread(target=scheduler.run)
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert len(runs) == 3
+    assert runs[2] - runs[0] >= 0.09
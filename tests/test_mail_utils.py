@@ -0,0 +1,135 @@
+from __future__ import unicode_literals
+
+from file_parser import email_mime
+from mail_utils import parse_fetch_response, build_uid_set, parse_uid_set, parse_imap_bodystructure, \
+    get_imap_partial_items, build_imap_partial_mail, split_uids_by_size, truncate_event
+
+BODYSTRUCTURE = (b'1 (UID 9 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 12 1 NIL NIL NIL NIL)'
+                 b'("APPLICATION" "PDF" ("NAME" "a.pdf") NIL NIL "BASE64" 5000 NIL ("ATTACHMENT" ("FILENAME" "a.pdf"))'
+                 b' NIL NIL) "MIXED" ("BOUNDARY" "BB") NIL NIL NIL))')
+
+
+def get_structure():
+    return parse_imap_bodystructure(parse_fetch_response([BODYSTRUCTURE])[0][1]['BODYSTRUCTURE'])
+
+
+def test_parse_fetch_response_literals_and_atoms():
+    data = [(b'1 (UID 5 RFC822 {11}', b'hello world'), b' INTERNALDATE "17-Jul-2020 02:44:25 -0700")',
+            (b'2 (UID 6 BODY[HEADER.FIELDS (MESSAGE-ID DATE)] {21}', b'Message-ID: <a@b>\r\n\r\n'),
+            b' RFC822.SIZE 42)']
+    assert parse_fetch_response(data) == [
+        (5, {'UID': '5', 'RFC822': b'hello world', 'INTERNALDATE': '17-Jul-2020 02:44:25 -0700'}),
+        (6, {'UID': '6', 'BODY[HEADER.FIELDS (MESSAGE-ID DATE)]': b'Message-ID: <a@b>\r\n\r\n',
+             'RFC822.SIZE': '42'}),
+    ]
+
+
+def test_parse_fetch_response_lists_and_partial_bodies():
+    data = [b'3 (UID 7 FLAGS (\\Seen) RFC822.SIZE 100)', (b'4 (UID 9 BODY[]<0> {3}', b'abc'), b')']
+    assert parse_fetch_response(data) == [
+        (7, {'UID': '7', 'FLAGS': ['\\Seen'], 'RFC822.SIZE': '100'}),
+        (9, {'UID': '9', 'BODY[]<0>': b'abc'}),
+    ]
+
+
+def test_parse_fetch_response_skips_unsolicited_responses():
+    """Servers may send FETCH responses without UID for flag changes of other mails"""
+    data = [b'4 (FLAGS (\\Seen))', (b'5 (UID 10 RFC822 {1}', b'x'), b')', None]
+    assert parse_fetch_response(data) == [(10, {'UID': '10', 'RFC822': b'x'})]
+
+
+def test_build_uid_set_merges_ranges():
+    assert build_uid_set([3, 1, 2, 7, 8, 8, 10]) == '1:3,7:8,10'
+    assert build_uid_set(['5']) == '5'
+
+
+def test_parse_uid_set_expands_ranges():
+    assert parse_uid_set('1:3,7,10:8') == [1, 2, 3, 7, 8, 9, 10]
+    assert parse_uid_set(b'4') == [4]
+    assert parse_uid_set('') == []
+
+
+def test_uid_set_round_trip():
+    uids = [1, 2, 3, 5, 9, 10, 11, 12, 40]
+    assert parse_uid_set(build_uid_set(uids)) == uids
+
+
+def test_split_uids_by_size():
+    sizes = {1: 9, 2: 9, 3: 1, 4: 5, 5: 20}
+    assert split_uids_by_size([1, 2, 3, 4, 5], sizes, 16) == [[1], [2, 3, 4], [5]]
+    assert split_uids_by_size([1, 6, 3], sizes, 16) == [[1], [6], [3]]
+    assert split_uids_by_size([], sizes, 16) == []
+
+
+def test_parse_imap_bodystructure_skips_attachments():
+    assert get_structure() == {
+        'section': '', 'boundary': 'BB', 'skipped': True,
+        'parts': [{'section': '1', 'size': 12, 'skipped': False}, {'section': '2', 'size': 5000, 'skipped': True}],
+    }
+
+
+def test_parse_imap_bodystructure_without_skipped_parts():
+    single_part = parse_fetch_response([b'1 (UID 9 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" '
+                                        b'12 1 NIL NIL NIL NIL))'])[0][1]['BODYSTRUCTURE']
+    assert parse_imap_bodystructure(single_part) is None
+    assert parse_imap_bodystructure(None) is None
+
+
+def test_get_imap_partial_items():
+    assert get_imap_partial_items(get_structure()) == [
+        'BODY.PEEK[HEADER]', 'BODY.PEEK[1.MIME]', 'BODY.PEEK[1]', 'BODY.PEEK[2.MIME]']
+    assert get_imap_partial_items(get_structure(), 10) == [
+        'BODY.PEEK[HEADER]', 'BODY.PEEK[1.MIME]', 'BODY.PEEK[1]<0.10>', 'BODY.PEEK[2.MIME]']
+
+
+def test_build_imap_partial_mail():
+    structure = get_structure()
+    message_data = {
+        'BODY[HEADER]': b'Subject: hi\r\nContent-Type: multipart/mixed; boundary="BB"\r\n\r\n',
+        'BODY[1.MIME]': b'Content-Type: text/plain\r\n\r\n',
+        'BODY[1]': b'hello there!',
+        'BODY[2.MIME]': b'Content-Type: application/pdf; name="a.pdf"\r\n\r\n',
+    }
+    raw_email = build_imap_partial_mail(structure, message_data)
+    assert b'hello there!' in raw_email
+    assert raw_email.count(b'--BB') == 3
+    del message_data['BODY[1]']
+    assert build_imap_partial_mail(structure, message_data) is None
+
+
+def test_partial_mail_marks_skipped_attachments():
+    message_data = {
+        'BODY[HEADER]': b'Subject: hi\r\nMessage-ID: <a@b>\r\nDate: Fri, 17 Jul 2020 02:44:25 -0700\r\n'
+                        b'Content-Type: multipart/mixed; boundary="BB"\r\n\r\n',
+        'BODY[1.MIME]': b'Content-Type: text/plain\r\n\r\n',
+        'BODY[1]': b'hello there!',
+        'BODY[2.MIME]': b'Content-Type: application/pdf; name="a.pdf"\r\n'
+                        b'Content-Disposition: attachment; filename="a.pdf"\r\n\r\n',
+    }
+    raw_email = build_imap_partial_mail(get_structure(), message_data)
+    event = email_mime.parse_email(raw_email, True, False, False, partial=True)[2]
+    assert 'hello there!' in event
+    assert '#SKIPPED_ATTACHMENT: file_name = a.pdf - type = application/pdf ; size = 5000' in event.splitlines()
+    assert 'md5 = ' not in event
+
+
+def test_truncate_event_keeps_small_events():
+    assert truncate_event('abc', 100, 3) == 'abc'
+
+
+def test_truncate_event_cuts_to_max_size():
+    event = truncate_event('x' * 1000, 100, 5000)
+    assert len(event.encode('utf-8')) <= 100
+    assert event.endswith('\n#TRUNCATED: mail_size = 5000 ; indexed_size = %d' % event.index('\n'))
+
+
+def test_truncate_event_does_not_split_characters():
+    event = truncate_event('ü' * 100, 80, 200)
+    assert len(event.encode('utf-8')) <= 80
+    kept = event.split('\n')[0]
+    assert kept == 'ü' * len(kept)
+    assert event.endswith('indexed_size = %d' % len(kept.encode('utf-8')))
+
+
+def test_truncate_event_marks_fetched_prefix():
+    assert truncate_event('short', 100, 5000, True) == 'short\n#TRUNCATED: mail_size = 5000 ; indexed_size = 5'